@@ -14,6 +14,9 @@ def usage(s=None):
     <intervals_file>          file containing a list of intervals to be masked,
                               in the form <chrom> <start> <end>;  --origin
                               determines whether these are origin one or zero
+                              (use - to read the intervals from stdin)
+    --fasta=<fasta_file>      read the sequences from this file rather than
+                              from stdin
     --chrom=<sequence_names>  copy (and mask) only the specified sequence(s)
                               <sequence_names> is a comma-separated list
                               (default is to copy and mask all sequences)
@@ -41,6 +44,7 @@ def main():
 	wrapLength       = 100
 	maskChar         = None
 	intervalsFile    = None
+	fastaFile        = None
 	unmask = False
 	minLength = None        
 
@@ -67,6 +71,8 @@ def main():
 			unmask = True
 		elif (arg.startswith("--minLength=")):
 			minLength = int(argVal)
+		elif (arg.startswith("--fasta=")):
+			fastaFile = argVal
 		elif (arg.startswith("--")):
 			usage("can't understand %s" % arg)
 		elif (intervalsFile == None):
@@ -79,7 +85,11 @@ def main():
 
 	# read the intervals
 
-	f = open(intervalsFile, "rt")
+	if (intervalsFile == "-"):
+		if (fastaFile == None): usage("--fasta is required when reading intervals from stdin")
+		f = stdin
+	else:
+		f = open(intervalsFile, "rt")
 
 	chromToIntervals = {}
 
@@ -120,7 +130,10 @@ def main():
 
 	chromSeen = {}
 
-	for (chrom,seq) in fasta_sequences(stdin):
+	if (fastaFile == None): fastaF = stdin
+	else:                   fastaF = open(fastaFile, "rt")
+
+	for (chrom,seq) in fasta_sequences(fastaF):
 		if (chromsOfInterest != None) and (chrom not in chromsOfInterest):
 			continue
 
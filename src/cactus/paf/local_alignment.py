@@ -15,11 +15,17 @@ from sonLib.bioio import newickTreeParser
 import os
 import shutil
 import math
+import functools
 from cactus.paf.paf import get_event_pairs, get_leaves, get_node, get_distances
 from cactus.shared.common import cactus_call, getOptionalAttrib
 from cactus.preprocessor.checkUniqueHeaders import sanitize_fasta_headers
 from cactus.shared.common import cactus_clamp_memory
 
+@functools.lru_cache(maxsize=32)
+def _split_lastz_params(lastz_params):
+    """ tokenize a lastzArguments string (there are only a few, shared by every pair of chunks) """
+    return tuple(lastz_params.split())
+
 def run_lastz(job, name_A, genome_A, name_B, genome_B, distance, params):
     # Create a local temporary file to put the alignments in.
     work_dir = job.fileStore.getLocalTempDir()
@@ -60,7 +66,7 @@ def run_lastz(job, name_A, genome_A, name_B, genome_B, distance, params):
     lastz_cmd = [lastz_bin,
                  '{}{}'.format(os.path.basename(genome_a_file), suffix_a),
                  '{}{}'.format(os.path.basename(genome_b_file), suffix_b),
-                 '--format=paf:minimap2'] + lastz_params.split(' ')
+                 '--format=paf:minimap2', *_split_lastz_params(lastz_params)]
         
     # note: it's very important to set the work_dir here, because cactus_call is not able to
     # sort out the mount directory by itself, presumably due to square brackets...
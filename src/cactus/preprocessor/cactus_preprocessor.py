@@ -49,7 +49,7 @@ from cactus.progressive.cactus_prepare import human2bytesN
 class PreprocessorOptions:
     def __init__(self, chunkSize, memory, cpu, check, proportionToSample, unmask,
                  preprocessJob, checkAssemblyHub=None, lastzOptions=None, minPeriod=None,
-                 gpu=0, lastz_memory=None, dnabrnnOpts=None,
+                 gpu=0, lastz_memory=None, lastzShards=None, prefilterK=0, lastzCache=False, dnabrnnOpts=None,
                  dnabrnnAction=None, redOpts=None, redPrefilterOpts=None, eventName=None, minLength=None,
                  cutBefore=None, cutBeforeOcc=None, cutAfter=None, inputBedID=None):
         self.chunkSize = chunkSize
@@ -68,6 +68,9 @@ class PreprocessorOptions:
             # wga-gpu has a 6G limit, so we always override
             self.chunkSize = 6000000000
         self.lastz_memory= lastz_memory
+        self.lastzShards = lastzShards
+        self.prefilterK = prefilterK
+        self.lastzCache = lastzCache
         self.dnabrnnOpts = dnabrnnOpts
         self.dnabrnnAction = dnabrnnAction
         assert dnabrnnAction in ('softmask', 'hardmask', 'clip')
@@ -156,6 +159,9 @@ class PreprocessSequence(RoundedJob):
                                                   cpu=self.prepOptions.cpu,
                                                   lastz_memory=self.prepOptions.lastz_memory,
                                                   gpuLastzInterval=self.prepOptions.gpuLastzInterval,
+                                                  lastzShards=self.prepOptions.lastzShards,
+                                                  prefilterK=self.prepOptions.prefilterK,
+                                                  cache=self.prepOptions.lastzCache,
                                                   eventName='{}_{}'.format(self.prepOptions.eventName, chunk_i))
             return LastzRepeatMaskJob(repeatMaskOptions=repeatMaskOptions,
                                       queryID=inChunkID,
@@ -200,10 +206,10 @@ class PreprocessSequence(RoundedJob):
             # chunk it up
             chunked = True
             inChunkDirectory = getTempDirectory(rootDir=fileStore.getLocalTempDir())
-            inChunkList = runGetChunks(sequenceFiles=[inSequence], chunksDir=inChunkDirectory,
-                                       chunkSize=self.prepOptions.chunkSize,
-                                       overlapSize=0)
-            inChunkList = [os.path.abspath(path) for path in inChunkList]
+            inChunkList = [os.path.abspath(path) for path in
+                           runGetChunks(sequenceFiles=[inSequence], chunksDir=inChunkDirectory,
+                                        chunkSize=self.prepOptions.chunkSize,
+                                        overlapSize=0)]
         logger.info("Chunks = %s" % inChunkList)
 
         inChunkIDList = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in inChunkList]
@@ -272,6 +278,9 @@ class BatchPreprocessor(RoundedJob):
                                               checkAssemblyHub = getOptionalAttrib(prepNode, "checkAssemblyHub", typeFn=bool, default=False),
                                               gpu = getOptionalAttrib(prepNode, "gpu", typeFn=int, default=0),
                                               lastz_memory = getOptionalAttrib(prepNode, "lastz_memory", typeFn=int, default=None),
+                                              lastzShards = getOptionalAttrib(prepNode, "lastzShards", typeFn=int, default=None),
+                                              prefilterK = getOptionalAttrib(prepNode, "prefilterK", typeFn=int, default=0),
+                                              lastzCache = getOptionalAttrib(prepNode, "lastzCache", typeFn=bool, default=False),
                                               dnabrnnOpts = getOptionalAttrib(prepNode, "dna-brnnOpts", default=""),
                                               dnabrnnAction = getOptionalAttrib(prepNode, "action", typeFn=str, default="softmask"),
                                               redOpts = getOptionalAttrib(prepNode, "redOpts", default=""),
@@ -461,7 +470,7 @@ def main():
     parser.add_argument("--binariesMode", choices=["docker", "local", "singularity"],
                         help="The way to run the Cactus binaries", default=None)
     parser.add_argument("--gpu", nargs='?', const='all', default=None, help="toggle on GPU-enabled lastz, and specify number of GPUs (all available if no value provided)")
-    parser.add_argument("--lastzCores", type=int, default=None, help="Number of cores for each lastz/segalign job, only relevant when running with --gpu")
+    parser.add_argument("--lastzCores", type=int, default=None, help="Number of cores for each lastz/segalign job. Without --gpu, this is also the number of lastz processes each repeatmasking job runs in parallel; each one loads the full target, so the job's memory scales with it unless --lastzMemory is set (in which case a single lastz process is used)")
     parser.add_argument("--lastzMemory", type=human2bytesN,
                         help="Memory in bytes for each lastz/segalign job (defaults to an estimate based on the input data size). "
                         "Standard suffixes like K, Ki, M, Mi, G or Gi are supported (default=bytes))", default=None)
@@ -6,6 +6,13 @@ import os
 import re
 import sys
 import shutil
+import shlex
+import hashlib
+import tempfile
+import subprocess
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from cactus.shared.common import cactus_cpu_count
 
@@ -14,8 +21,68 @@ from sonLib.bioio import catFiles
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
 from toil.realtimeLogger import RealtimeLogger
+from toil.jobStores.abstractJobStore import NoSuchFileException
+
+def _fasta_records(fasta_file):
+    """ yield (name, sequence) byte strings from an open binary fasta file, where name is the first
+    word of the header """
+    name = None
+    seq = bytearray()
+    for line in fasta_file:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, seq
+            name = line[1:].split()[0]
+            seq = bytearray()
+        else:
+            assert name is not None, "first sequence has no header"
+            seq += line.strip()
+    if name is not None:
+        yield name, seq
+
+def _emit_fragments(query_path, out_path, fragment, step, masks=None):
+    """
+    In-process equivalent of cactus_fasta_fragments.py --fragment=<fragment> --step=<step> --origin=zero:
+    write (uppercased) windows of the query, skipping those that are entirely N.
+    If given, masks maps sequence names to boolean arrays of already-masked bases, and windows
+    that are entirely masked are skipped too.
+    """
+    all_n = b'N' * fragment
+    with open(query_path, 'rb') as query_file, open(out_path, 'wb', buffering=1<<20) as out_file:
+        for name, seq in _fasta_records(query_file):
+            seq = seq.upper()
+            mask = masks.get(name) if masks else None
+            for i in range(0, len(seq), step):
+                frag = seq[i:i + fragment]
+                if frag == all_n or (mask is not None and mask[i:i + fragment].all()):
+                    continue
+                out_file.write(b'>%s_%d\n%s\n' % (name, i, frag))
+
+def _split_fasta(fasta_path, out_paths):
+    """
+    Split a fasta file into len(out_paths) pieces of roughly equal size, breaking only between
+    records and preserving their order (so that concatenating the pieces gives back the input).
+    """
+    target_size = os.path.getsize(fasta_path) / len(out_paths)
+    with open(fasta_path, 'rb') as fasta_file:
+        out_i = 0
+        out_file = open(out_paths[out_i], 'wb', buffering=1<<20)
+        for line in fasta_file:
+            if line.startswith(b'>') and out_i < len(out_paths) - 1 and out_file.tell() >= target_size:
+                out_file.close()
+                out_i += 1
+                out_file = open(out_paths[out_i], 'wb', buffering=1<<20)
+            out_file.write(line)
+        out_file.close()
+    for out_path in out_paths[out_i + 1:]:
+        open(out_path, 'wb').close()
 
 class RepeatMaskOptions:
+    # one of these is pickled with every LastzRepeatMaskJob
+    __slots__ = ('fragment', 'minPeriod', 'lastzOpts', 'unmaskInput', 'unmaskOutput', 'proportionSampled',
+                 'gpu', 'cpu', 'lastz_memory', 'gpuLastzInterval', 'lastzShards', 'cache', 'prefilterK',
+                 'eventName', 'period')
+
     def __init__(self,
             fragment=200,
             minPeriod=10,
@@ -27,6 +94,9 @@ class RepeatMaskOptions:
             cpu=None,
             lastz_memory=None,
             gpuLastzInterval=3000000,
+            lastzShards=None,
+            cache=False,
+            prefilterK=0,
             eventName='seq'):
         self.fragment = fragment
         self.minPeriod = minPeriod
@@ -38,6 +108,15 @@ class RepeatMaskOptions:
         self.cpu = cpu
         self.lastz_memory = lastz_memory
         self.gpuLastzInterval = gpuLastzInterval
+        # by default, use one lastz process per core.  but an explicit lastz_memory is the job's whole
+        # memory request, and each shard loads the full target, so only shard within it if asked to
+        self.lastzShards = lastzShards if lastzShards else (cpu if cpu and not gpu and not lastz_memory else 1)
+        # reuse the masked output of an identical job.  off by default: the key includes the
+        # (jobstore-specific) file ids and every result is kept as a shared file in the jobstore
+        self.cache = cache
+        # if > 0, directly mask query bases covered by k-mers of this size that are too
+        # frequent in the targets, and only align the remaining fragments with lastz
+        self.prefilterK = prefilterK
         self.eventName = eventName
 
         self.period = max(1, round(self.proportionSampled * self.minPeriod))
@@ -55,41 +134,114 @@ class LastzRepeatMaskJob(RoundedJob):
         elif repeatMaskOptions.gpu:
             memory = min(40 * targetsSize, 512e9)
         else:
-            memory = 4*1024*1024*1024
+            # lastz needs the target sequence plus its seed table (a few bytes per base), which is well
+            # under the flat 4G we used to reserve for small inputs.  each lastz shard loads the whole target
+            lastz_memory = min(4*1024*1024*1024, max(1024*1024*1024, 3 * (queryID.size + targetsSize)))
+            memory = lastz_memory * max(1, repeatMaskOptions.lastzShards)
+        if repeatMaskOptions.prefilterK:
+            # the k-mer prefilter runs before any alignment, and only its mask of the query (a byte per
+            # base) is kept while aligning
+            from cactus.preprocessor.lastzRepeatMasking import kmerPrefilter
+            memory = max(memory + queryID.size,
+                         kmerPrefilter.memory_estimate(repeatMaskOptions.prefilterK, queryID.size, targetsSize))
         disk = max(4*(queryID.size + targetsSize), memory)
         cores = repeatMaskOptions.cpu
+        if repeatMaskOptions.lastzShards > 1 and not repeatMaskOptions.gpu:
+            cores = max(cores if cores else 1, repeatMaskOptions.lastzShards)
         accelerators = ['cuda:{}'.format(repeatMaskOptions.gpu)] if repeatMaskOptions.gpu else None            
         RoundedJob.__init__(self, memory=memory, disk=disk, cores=cores, accelerators=accelerators, preemptable=True)
         self.repeatMaskOptions = repeatMaskOptions
         self.queryID = queryID
         self.targetIDs = targetIDs
 
-    def getFragments(self, fileStore, queryFile):
+    def getFragments(self, fileStore, queryFile, masks=None):
         """
         Chop up the query fasta into fragments of a certain size, overlapping by half their length.
         """
-        fragments = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '_frag')        
-        cactus_call(infile=queryFile, outfile=fragments,
-                    parameters=["cactus_fasta_fragments.py",
-                                "--fragment=%s" % str(self.repeatMaskOptions.fragment),
-                                "--step=%s" % (str(self.repeatMaskOptions.fragment // 2)),
-                                "--origin=zero"])
+        fragments = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '_frag')
+        _emit_fragments(queryFile, fragments, self.repeatMaskOptions.fragment, self.repeatMaskOptions.fragment // 2,
+                        masks=masks)
         return fragments
 
-    def alignFastaFragments(self, fileStore, targetFiles, fragments):
+    def prefilterQuery(self, fileStore, queryFile, targetFiles):
         """
-        Align each query fragment against all the target chunks, stopping
-        early to avoid exponential blowup if too many alignments are found.
+        Mask the query bases covered by k-mers that occur more than period times in the targets
+        (not counting the query's own copy).  Returns the masks, along with a file of the masked
+        intervals for the softmasker.
+        """
+        from cactus.preprocessor.lastzRepeatMasking import kmerPrefilter
+        k = self.repeatMaskOptions.prefilterK
+        def target_records():
+            for targetFile in targetFiles:
+                with open(targetFile, 'rb') as target_file:
+                    yield from _fasta_records(target_file)
+        counts = kmerPrefilter.count_kmers(target_records(), k)
+        masks = {}
+        prefilterIntervals = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.prefilter')
+        with open(queryFile, 'rb') as query_file, open(prefilterIntervals, 'wb', buffering=1<<20) as intervals_file:
+            for name, seq in _fasta_records(query_file):
+                masks[name] = kmerPrefilter.repeat_mask(seq, counts, k, self.repeatMaskOptions.period + 2)
+                kmerPrefilter.write_mask_intervals(name, masks[name], intervals_file)
+        return masks, prefilterIntervals
+
+    @contextmanager
+    def catTargets(self, targetFiles, stream=True):
+        """
+        Concatenate the target chunks into a single fasta for lastz's [multiple] target.
         """
         target = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.fa')
-        catFiles(targetFiles, target)
-        lastZSequenceHandling  = ['%s[multiple][nameparse=darkspace]' % os.path.basename(target), '%s[nameparse=darkspace]' % os.path.basename(fragments)]
-        if self.repeatMaskOptions.unmaskInput:
-            lastZSequenceHandling  = ['%s[multiple,unmask][nameparse=darkspace]' % os.path.basename(target), '%s[unmask][nameparse=darkspace]' % os.path.basename(fragments)]
+        # lastz reads its [multiple] target sequentially, so rather than writing the concatenated
+        # targets to disk we stream them through a fifo.  kegalign needs a real file, as do
+        # multiple lastz shards reading the same target.
+        cat_proc = None
+        if stream and not self.repeatMaskOptions.gpu:
+            try:
+                os.mkfifo(target)
+            except (OSError, AttributeError):
+                pass
+            else:
+                cat_proc = subprocess.Popen('cat {} > {}'.format(shlex.join(targetFiles),
+                                                                 shlex.quote(target)), shell=True)
+        if cat_proc is None:
+            catFiles(targetFiles, target)
+        try:
+            yield target
+        except BaseException:
+            if cat_proc is not None:
+                # if lastz failed before opening the fifo, cat will be blocked on it
+                if cat_proc.poll() is None:
+                    cat_proc.kill()
+                cat_proc.wait()
+                os.remove(target)
+            raise
+        if cat_proc is not None:
+            try:
+                # lastz is done with the target, so cat should be too
+                cat_proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                cat_proc.kill()
+                cat_proc.wait()
+            finally:
+                os.remove(target)
+            # a missing or unreadable chunk just looks like the end of the target to lastz
+            if cat_proc.returncode != 0:
+                raise RuntimeError('Streaming the targets {} to {} failed with exit code {}'.format(
+                    targetFiles, target, cat_proc.returncode))
+
+    def getLastzCommand(self, target, fragments):
+        """
+        Command to align each query fragment against all the target chunks, stopping
+        early to avoid exponential blowup if too many alignments are found.
+        """
+        target_name = os.path.basename(target)
+        fragments_name = os.path.basename(fragments)
         if self.repeatMaskOptions.gpu:
             assert not self.repeatMaskOptions.unmaskInput
-            lastZSequenceHandling = ['%s' % os.path.basename(target), '%s' % os.path.basename(fragments)]
-        alignment = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.cigar')
+            lastZSequenceHandling = [target_name, fragments_name]
+        elif self.repeatMaskOptions.unmaskInput:
+            lastZSequenceHandling = ['{}[multiple,unmask][nameparse=darkspace]'.format(target_name), '{}[unmask][nameparse=darkspace]'.format(fragments_name)]
+        else:
+            lastZSequenceHandling = ['{}[multiple][nameparse=darkspace]'.format(target_name), '{}[nameparse=darkspace]'.format(fragments_name)]
         # Each time a fragment aligns to a base in the sequence, that
         # base's match count is incremented.  the plus three for the
         # period parameter is a fudge to ensure sufficient alignments
@@ -103,12 +255,49 @@ class LastzRepeatMaskJob(RoundedJob):
              "--markend"]
         if self.repeatMaskOptions.gpu:
             lastz_cmd += ['--num_threads', str(self.cores)]
-        kegalign_messages = cactus_call(outfile=alignment,
-                                        work_dir=self.work_dir,
-                                        parameters=lastz_cmd,
-                                        job_memory=self.memory,
-                                        returnStdErr=self.repeatMaskOptions.gpu,
-                                        gpus=self.repeatMaskOptions.gpu)
+        return lastz_cmd
+
+    def getMaskCommands(self, queryFile, prefilterIntervals=None):
+        """
+        Commands to turn alignments (on stdin) into a softmasked query (on stdout).
+        Anything with more alignments than the period gets masked, as does anything in prefilterIntervals.
+        """
+        #This runs Bob's covered intervals program, which combines the lastz alignment info into intervals of the query.
+
+        # covered_intervals is part of segalign, so only run if not in gpu mode
+        # * 2 takes into account the effect of the overlap
+        scale_period = 2
+
+        covered_call_cmd = ["cactus_covered_intervals",
+                            "--origin=one",
+                            "M=%s" % (int(self.repeatMaskOptions.period * scale_period))]
+
+        covered_call_cmd += ["--queryoffsets"]
+
+        # covered_intervals outputs intervals (denoted with indices) to softmask.
+        # we finish by applying these intervals to the input file, to produce the final, softmasked output.
+        args = ["--origin=one", "--fasta={}".format(os.path.basename(queryFile))]
+        if self.repeatMaskOptions.unmaskOutput:
+            args.append("--unmask")
+        args.append("-")
+        mask_cmds = [covered_call_cmd, ["cactus_fasta_softmask_intervals.py"] + args]
+        if prefilterIntervals:
+            mask_cmds.insert(1, ['cat', os.path.basename(prefilterIntervals), '-'])
+        return mask_cmds
+
+    def alignFastaFragments(self, fileStore, targetFiles, fragments):
+        """
+        Align each query fragment against all the target chunks, writing the alignments to a file.
+        """
+        alignment = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.cigar')
+        with self.catTargets(targetFiles) as target:
+            lastz_cmd = self.getLastzCommand(target, fragments)
+            kegalign_messages = cactus_call(outfile=alignment,
+                                            work_dir=self.work_dir,
+                                            parameters=lastz_cmd,
+                                            job_memory=self.memory,
+                                            returnStdErr=self.repeatMaskOptions.gpu,
+                                            gpus=self.repeatMaskOptions.gpu)
         if self.repeatMaskOptions.gpu:
             # run_kegalign can crash and still exit 0, so it's worth taking a moment to check the log for errors
             kegalign_messages = kegalign_messages.lower()
@@ -116,7 +305,7 @@ class LastzRepeatMaskJob(RoundedJob):
                 if not line.startswith("signals delivered"):
                     for keyword in ['terminate', 'error', 'fail', 'assert', 'signal', 'abort', 'segmentation', 'sigsegv', 'kill']:
                         if keyword in line and 'signals' not in line:
-                            job.fileStore.logToMaster("KegAlign offending line: " + line)  # Log the messages
+                            fileStore.logToMaster("KegAlign offending line: " + line)  # Log the messages
                             raise RuntimeError('{} exited 0 but keyword "{}" found in stderr'.format(lastz_cmd, keyword))
 
             # kegalign will write an invalid file if the output is empty.  correct it here!
@@ -132,49 +321,125 @@ class LastzRepeatMaskJob(RoundedJob):
                 
         return alignment
 
-    def maskCoveredIntervals(self, fileStore, queryFile, alignment):
+    def maskCoveredIntervals(self, fileStore, queryFile, alignment, prefilterIntervals=None):
         """
-        Mask the query fasta using the alignments to the target. Anything with more alignments than the period gets masked.
+        Mask the query fasta using the alignments to the target.
         """
-        #This runs Bob's covered intervals program, which combines the lastz alignment info into intervals of the query.
-        maskInfo = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.maskinfo')
-
-        # covered_intervals is part of segalign, so only run if not in gpu mode
-        # * 2 takes into account the effect of the overlap
-        scale_period = 2
+        maskedQuery = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.maskedQeury')
+        cactus_call(infile=alignment, outfile=maskedQuery, work_dir=self.work_dir,
+                    parameters=self.getMaskCommands(queryFile, prefilterIntervals), job_memory=self.memory)
+        return maskedQuery
 
-        covered_call_cmd = ["cactus_covered_intervals",
-                            "--origin=one",
-                            "M=%s" % (int(self.repeatMaskOptions.period * scale_period))]
+    def alignAndMaskFastaFragments(self, fileStore, queryFile, targetFiles, fragments, prefilterIntervals=None):
+        """
+        Align the query fragments to the targets and mask the query in a single pipeline, so
+        that neither the alignments nor the intervals ever hit the disk.
+        """
+        if self.repeatMaskOptions.lastzShards > 1:
+            return self.alignAndMaskFastaFragmentsSharded(fileStore, queryFile, targetFiles, fragments, prefilterIntervals)
+        maskedQuery = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.maskedQeury')
+        with self.catTargets(targetFiles) as target:
+            cactus_call(outfile=maskedQuery, work_dir=self.work_dir,
+                        parameters=[self.getLastzCommand(target, fragments)] + self.getMaskCommands(queryFile, prefilterIntervals),
+                        job_memory=self.memory)
+        return maskedQuery
 
-        covered_call_cmd += ["--queryoffsets"]
-        cactus_call(infile=alignment, outfile=maskInfo, parameters=covered_call_cmd, job_memory=self.memory)
+    def alignAndMaskFastaFragmentsSharded(self, fileStore, queryFile, targetFiles, fragments, prefilterIntervals=None):
+        """
+        Like alignAndMaskFastaFragments, but split the fragments into lastzShards contiguous pieces
+        and align them in parallel.  Since the fragments stay in order, so do the concatenated
+        alignments, which is what covered_intervals requires.
+        """
+        num_shards = self.repeatMaskOptions.lastzShards
+        shard_fragments = ['{}_{}'.format(fragments, i) for i in range(num_shards)]
+        _split_fasta(fragments, shard_fragments)
+        # small queries may not fill every shard
+        shard_fragments = [shard_fragment for shard_fragment in shard_fragments if os.path.getsize(shard_fragment) > 0]
+        shard_alignments = [os.path.join(self.work_dir, '{}_{}.cigar'.format(self.repeatMaskOptions.eventName, i)) for i in range(len(shard_fragments))]
+        with self.catTargets(targetFiles, stream=False) as target:
+            with ThreadPoolExecutor(max_workers=len(shard_fragments)) as executor:
+                futures = [executor.submit(cactus_call, outfile=shard_alignment, work_dir=self.work_dir,
+                                           parameters=self.getLastzCommand(target, shard_fragment),
+                                           job_memory=self.memory)
+                           for shard_fragment, shard_alignment in zip(shard_fragments, shard_alignments)]
+                for future in futures:
+                    future.result()
 
-        # the previous lastz command outputs a file of intervals (denoted with indices) to softmask.
-        # we finish by applying these intervals to the input file, to produce the final, softmasked output.
-        args = ["--origin=one"]
-        if self.repeatMaskOptions.unmaskOutput:
-            args.append("--unmask")
-        args.append(os.path.basename(maskInfo))
         maskedQuery = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.maskedQeury')
-        cactus_call(infile=queryFile, outfile=maskedQuery, work_dir=self.work_dir,
-                    parameters=["cactus_fasta_softmask_intervals.py"] + args)
+        cactus_call(outfile=maskedQuery, work_dir=self.work_dir,
+                    parameters=[['cat'] + [os.path.basename(a) for a in shard_alignments]] + self.getMaskCommands(queryFile, prefilterIntervals),
+                    job_memory=self.memory)
         return maskedQuery
 
+    def getCacheName(self):
+        """
+        Name of the jobstore shared file that holds the result of this job, keyed on its inputs
+        """
+        cache_key = hashlib.blake2b(digest_size=20)
+        cache_key.update(str(self.queryID).encode())
+        for targetID in sorted(str(targetID) for targetID in self.targetIDs):
+            cache_key.update(targetID.encode())
+        cache_key.update(repr([(slot, getattr(self.repeatMaskOptions, slot)) for slot in RepeatMaskOptions.__slots__]).encode())
+        return 'repeatmask-cache-{}'.format(cache_key.hexdigest())
+
     def run(self, fileStore):
         """
         Using sampled target fragments, mask repetitive regions of the query.
         """
         assert len(self.targetIDs) >= 1
         assert self.repeatMaskOptions.fragment > 1
-        self.work_dir = fileStore.getLocalTempDir()
+        # CACTUS_TMPDIR can point the (large) intermediate files at node-local scratch when
+        # toil's work directory is on a network filesystem
+        scratch_dir = os.environ.get('CACTUS_TMPDIR')
+        if not scratch_dir:
+            self.work_dir = fileStore.getLocalTempDir()
+            return self.maskQuery(fileStore)
+        self.work_dir = tempfile.mkdtemp(dir=scratch_dir)
+        try:
+            return self.maskQuery(fileStore)
+        finally:
+            shutil.rmtree(self.work_dir)
+
+    def maskQuery(self, fileStore):
+        """
+        Do the work of run() in self.work_dir.
+        """
+        cache_name = self.getCacheName() if self.repeatMaskOptions.cache else None
+        if cache_name:
+            maskedQuery = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.maskedQeury')
+            try:
+                with fileStore.jobStore.readSharedFileStream(cache_name) as cache_stream, open(maskedQuery, 'wb') as masked_file:
+                    shutil.copyfileobj(cache_stream, masked_file, 1<<20)
+                RealtimeLogger.info('Using cached repeatmasking result {} for {}'.format(cache_name, self.repeatMaskOptions.eventName))
+                return fileStore.writeGlobalFile(maskedQuery)
+            except NoSuchFileException:
+                pass
+
+        # none of the inputs are modified, so symlink them from the cache rather than copying where possible.
+        # the targets are only ever read on the host (to concatenate them), but the query is read by the
+        # softmasker, which can't follow links out of work_dir when running in a container
         queryFile = os.path.join(self.work_dir, self.repeatMaskOptions.eventName + '.query')
-        fileStore.readGlobalFile(self.queryID, queryFile)
+        fileStore.readGlobalFile(self.queryID, queryFile,
+                                 symlink=os.environ.get("CACTUS_BINARIES_MODE") == "local")
         targetFiles = [os.path.join(self.work_dir, '{}_{}.tgt'.format(self.repeatMaskOptions.eventName, i)) for i in range(len(self.targetIDs))]
         for targetFile, fileID in zip(targetFiles, self.targetIDs):
-            fileStore.readGlobalFile(fileID, targetFile)
+            fileStore.readGlobalFile(fileID, targetFile, symlink=True)
 
-        fragments = self.getFragments(fileStore, queryFile)
-        alignment = self.alignFastaFragments(fileStore, targetFiles, fragments)
-        maskedQuery = self.maskCoveredIntervals(fileStore, queryFile, alignment)
+        masks, prefilterIntervals = None, None
+        if self.repeatMaskOptions.prefilterK:
+            masks, prefilterIntervals = self.prefilterQuery(fileStore, queryFile, targetFiles)
+
+        fragments = self.getFragments(fileStore, queryFile, masks)
+        if os.path.getsize(fragments) == 0:
+            # nothing left to align
+            maskedQuery = self.maskCoveredIntervals(fileStore, queryFile, os.devnull, prefilterIntervals)
+        elif self.repeatMaskOptions.gpu:
+            # kegalign's output needs to be checked before it can be used
+            alignment = self.alignFastaFragments(fileStore, targetFiles, fragments)
+            maskedQuery = self.maskCoveredIntervals(fileStore, queryFile, alignment, prefilterIntervals)
+        else:
+            maskedQuery = self.alignAndMaskFastaFragments(fileStore, queryFile, targetFiles, fragments, prefilterIntervals)
+        if cache_name:
+            with fileStore.jobStore.writeSharedFileStream(cache_name) as cache_stream, open(maskedQuery, 'rb') as masked_file:
+                shutil.copyfileobj(masked_file, cache_stream, 1<<20)
         return fileStore.writeGlobalFile(maskedQuery)
@@ -1,14 +1,18 @@
 import time
+import subprocess
+import sys
 
 from cactus.preprocessor.preprocessorTest import *
 from cactus.preprocessor.preprocessorTest import TestCase as PreprocessorTestCase
 from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMask import LastzRepeatMaskJob
 from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMask import RepeatMaskOptions
+from cactus.preprocessor.lastzRepeatMasking.cactus_lastzRepeatMask import _emit_fragments, _split_fasta
 
 from toil.common import Toil
 from toil.job import Job
 
 from cactus.shared.common import makeURL
+from cactus.shared.common import cactusRootPath
 
 """This test compares running the lastz repeat masking script to the underlying repeat masking of input sequences,
 comparing two settings of lastz.
@@ -87,5 +91,103 @@ class TestCase(PreprocessorTestCase):
             self.assertGreater(recall, 0.93)
 
 
+class FragmentTestCase(unittest.TestCase):
+    """Check the in-process fasta fragmenting against cactus_fasta_fragments.py, which it replaces
+    """
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.fastaPath = os.path.join(self.tempDir, "query.fa")
+        with open(self.fastaPath, "w") as fastaFile:
+            # multi-line lowercase/mixed records, all-N windows, partial tail windows (including
+            # an all-N one), a record shorter than a fragment and an empty record
+            fastaFile.write(">seq1 some description\n")
+            fastaFile.write("acgtACGTnnacgt" * 7 + "\n" + "N" * 45 + "\n" + "ggCCaaTT" * 5 + "\n")
+            fastaFile.write(">seq2\n" + "N" * 63 + "\n")
+            fastaFile.write(">seq3\nacgtnacgt\n")
+            fastaFile.write(">empty\n")
+            fastaFile.write(">seq4\n" + "tTgGcCaA" * 20 + "N" * 30 + "\n\n" + "acg" * 11 + "\n")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def fastaFragmentsScript(self):
+        script = shutil.which("cactus_fasta_fragments.py")
+        if script is None:
+            script = os.path.join(os.path.dirname(os.path.dirname(cactusRootPath())), "preprocessor",
+                                  "lastzRepeatMasking", "cactus_fasta_fragments.py")
+        if not os.path.isfile(script):
+            self.skipTest("cactus_fasta_fragments.py not found")
+        return script
+
+    def testEmitFragments(self):
+        script = self.fastaFragmentsScript()
+        for fragment in (10, 16, 30):
+            step = fragment // 2
+            with open(self.fastaPath, "rb") as fastaFile:
+                expected = subprocess.check_output([sys.executable, script, "--fragment={}".format(fragment),
+                                                    "--step={}".format(step), "--origin=zero"], stdin=fastaFile)
+            fragmentsPath = os.path.join(self.tempDir, "fragments.fa")
+            _emit_fragments(self.fastaPath, fragmentsPath, fragment, step)
+            with open(fragmentsPath, "rb") as fragmentsFile:
+                self.assertEqual(fragmentsFile.read(), expected)
+
+    def testSplitFasta(self):
+        with open(self.fastaPath, "rb") as fastaFile:
+            fasta = fastaFile.read()
+        for numPieces in (1, 2, 3, 10):
+            piecePaths = [os.path.join(self.tempDir, "piece{}.fa".format(i)) for i in range(numPieces)]
+            _split_fasta(self.fastaPath, piecePaths)
+            pieces = []
+            for piecePath in piecePaths:
+                with open(piecePath, "rb") as pieceFile:
+                    pieces.append(pieceFile.read())
+            # pieces are only broken between records
+            for piece in pieces:
+                self.assertTrue(not piece or piece.startswith(b">"))
+            self.assertEqual(b"".join(pieces), fasta)
+
+
+class CatTargetsTestCase(unittest.TestCase):
+    """Check that the targets streamed to lastz are complete, or the job fails
+    """
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.targetFiles = []
+        for i in range(3):
+            self.targetFiles.append(os.path.join(self.tempDir, "target{}.fa".format(i)))
+            with open(self.targetFiles[-1], "w") as targetFile:
+                targetFile.write(">t{}\n{}\n".format(i, "ACGT" * (i + 1) * 1000))
+        # catTargets only needs the options and the work dir
+        self.job = LastzRepeatMaskJob.__new__(LastzRepeatMaskJob)
+        self.job.repeatMaskOptions = RepeatMaskOptions(eventName="test")
+        self.job.work_dir = self.tempDir
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def readTarget(self, targetFiles, stream=True):
+        with self.job.catTargets(targetFiles, stream=stream) as target:
+            with open(target, "rb") as targetFile:
+                return targetFile.read()
+
+    def testCatTargets(self):
+        expected = b""
+        for targetFile in self.targetFiles:
+            with open(targetFile, "rb") as f:
+                expected += f.read()
+        for stream in (True, False):
+            self.assertEqual(self.readTarget(self.targetFiles, stream=stream), expected)
+
+    def testCatTargetsMissing(self):
+        targetFiles = self.targetFiles[:1] + [os.path.join(self.tempDir, "missing.fa")] + self.targetFiles[1:]
+        for stream in (True, False):
+            with self.assertRaises((RuntimeError, IOError)):
+                self.readTarget(targetFiles, stream=stream)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Optional k-mer prefilter for lastz repeat masking.
+
+Count the (canonical) k-mers of the targets, then directly mask any query base covered by a
+k-mer that is too frequent in the targets.  Fragments that are completely masked this way don't
+need to be aligned with lastz at all.
+
+Requires numpy, which is only imported when the prefilter is used.
+"""
+
+import numpy as np
+
+# process sequences in blocks of this many bases to bound memory
+_BLOCK_SIZE = 1 << 22
+# upper bound on the working memory (in bytes) per base of a block: the int64 codes, cumulative sums and
+# their temporaries, along with the sorting done by np.unique
+_BLOCK_BYTES_PER_BASE = 128
+
+# A,C,G,T (any case) -> 0,1,2,3.  everything else -> 4
+_ENCODE = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(b'ACGT'):
+    _ENCODE[_c] = _i
+    _ENCODE[ord(chr(_c).lower())] = _i
+
+def _canonical_kmers(seq, k):
+    """
+    Return (codes, valid) for every k-mer starting position of seq (a bytes-like sequence),
+    where codes[i] is the smaller of the 2-bit encodings of the k-mer and its reverse
+    complement, and valid[i] is False if the k-mer contains anything other than ACGT.
+    """
+    bases = _ENCODE[np.frombuffer(seq, dtype=np.uint8)]
+    num_kmers = len(bases) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    invalid = np.concatenate(([0], np.cumsum(bases == 4)))
+    valid = invalid[k:] - invalid[:num_kmers] == 0
+    bases = np.minimum(bases, 3).astype(np.int64)
+    forward = np.zeros(num_kmers, dtype=np.int64)
+    reverse = np.zeros(num_kmers, dtype=np.int64)
+    for j in range(k):
+        forward = forward * 4 + bases[j:j + num_kmers]
+        reverse = reverse * 4 + (3 - bases[k - 1 - j:k - 1 - j + num_kmers])
+    return np.minimum(forward, reverse), valid
+
+def _blocks(seq, k):
+    """ yield (offset, block) covering every k-mer of seq exactly once """
+    for start in range(0, max(1, len(seq) - k + 1), _BLOCK_SIZE):
+        yield start, seq[start:start + _BLOCK_SIZE + k - 1]
+
+def memory_estimate(k, query_size, target_size):
+    """
+    Bytes needed to prefilter a query of query_size bases against targets totalling target_size bases:
+    the count table, the per-block arrays, the query's per-base coverage and mask arrays (about 10
+    bytes per base, with the sequence itself) and the largest target sequence, which is at most all of them.
+    """
+    return 2 * 4 ** k + _BLOCK_BYTES_PER_BASE * (_BLOCK_SIZE + k) + 10 * query_size + target_size
+
+def count_kmers(fasta_records, k):
+    """
+    Count the canonical k-mers in the given (name, sequence) records.  Counts saturate at 65535.
+    """
+    counts = np.zeros(4 ** k, dtype=np.uint16)
+    for name, seq in fasta_records:
+        for offset, block in _blocks(seq, k):
+            codes, valid = _canonical_kmers(block, k)
+            kmers, kmer_counts = np.unique(codes[valid], return_counts=True)
+            counts[kmers] = np.minimum(counts[kmers].astype(np.int64) + kmer_counts, 65535)
+    return counts
+
+def repeat_mask(seq, counts, k, min_count):
+    """
+    Return a boolean array over seq that is True for every base covered by a k-mer
+    occurring at least min_count times in counts.
+    """
+    coverage = np.zeros(len(seq) + 1, dtype=np.int32)
+    for offset, block in _blocks(seq, k):
+        codes, valid = _canonical_kmers(block, k)
+        starts = offset + np.flatnonzero(valid & (counts[codes] >= min_count))
+        coverage[starts] += 1
+        coverage[starts + k] -= 1
+    return np.cumsum(coverage[:-1], dtype=np.int32) > 0
+
+def write_mask_intervals(name, mask, out_file):
+    """
+    Write the masked runs of a sequence to an open binary file as origin-one, closed intervals
+    (as output by cactus_covered_intervals --origin=one)
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    for start, end in zip(edges[::2], edges[1::2]):
+        out_file.write(b'%s\t%d\t%d\n' % (name, start + 1, end))
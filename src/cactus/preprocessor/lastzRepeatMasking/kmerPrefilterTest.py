@@ -0,0 +1,120 @@
+import io
+import random
+import unittest
+
+try:
+    import numpy as np
+    from cactus.preprocessor.lastzRepeatMasking import kmerPrefilter
+except ImportError:
+    np = None
+
+"""Check the numpy k-mer prefilter against brute-force counting on small sequences.
+"""
+
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+def _code(kmer):
+    code = 0
+    for base in kmer:
+        code = code * 4 + 'ACGT'.index(base)
+    return code
+
+def _canonical(kmer):
+    kmer = kmer.upper()
+    if any(base not in _COMPLEMENT for base in kmer):
+        return None
+    reverse = ''.join(_COMPLEMENT[base] for base in reversed(kmer))
+    return min(_code(kmer), _code(reverse))
+
+def _brute_counts(records, k):
+    counts = {}
+    for name, seq in records:
+        seq = seq.decode()
+        for i in range(len(seq) - k + 1):
+            code = _canonical(seq[i:i + k])
+            if code is not None:
+                counts[code] = counts.get(code, 0) + 1
+    return counts
+
+def _brute_mask(seq, counts, k, min_count):
+    seq = seq.decode()
+    mask = [False] * len(seq)
+    for i in range(len(seq) - k + 1):
+        code = _canonical(seq[i:i + k])
+        if code is not None and counts[code] >= min_count:
+            for j in range(i, i + k):
+                mask[j] = True
+    return mask
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1)
+        self.block_size = kmerPrefilter._BLOCK_SIZE
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        kmerPrefilter._BLOCK_SIZE = self.block_size
+        unittest.TestCase.tearDown(self)
+
+    def randomRecords(self):
+        """ mixed case sequences, with runs of Ns, repeats, and some shorter than k """
+        repeat = ''.join(self.random.choice('ACGT') for i in range(12))
+        records = []
+        for i in range(8):
+            seq = []
+            while sum(len(s) for s in seq) < self.random.randint(0, 150):
+                choice = self.random.random()
+                if choice < 0.1:
+                    seq.append('N' * self.random.randint(1, 8))
+                elif choice < 0.4:
+                    seq.append(repeat.lower() if self.random.random() < 0.5 else repeat)
+                else:
+                    seq.append(''.join(self.random.choice('ACGTacgt') for j in range(self.random.randint(1, 10))))
+            records.append((b'seq%d' % i, ''.join(seq).encode()))
+        records += [(b'empty', b''), (b'short', b'ACg'), (b'allN', b'NNNNNNNNNN')]
+        return records
+
+    def checkPrefilter(self, k):
+        records = self.randomRecords()
+        counts = kmerPrefilter.count_kmers(records, k)
+        brute_counts = _brute_counts(records, k)
+        self.assertEqual({int(code): int(counts[code]) for code in np.flatnonzero(counts)}, brute_counts)
+
+        dense_counts = [0] * 4 ** k
+        for code, count in brute_counts.items():
+            dense_counts[code] = count
+        for min_count in (1, 2, 5):
+            intervals = io.BytesIO()
+            brute_intervals = []
+            for name, seq in records:
+                mask = kmerPrefilter.repeat_mask(seq, counts, k, min_count)
+                brute_mask = _brute_mask(seq, dense_counts, k, min_count)
+                self.assertEqual(list(mask), brute_mask)
+                kmerPrefilter.write_mask_intervals(name, mask, intervals)
+                # origin-one, closed intervals of the masked runs
+                i = 0
+                while i < len(brute_mask):
+                    if brute_mask[i]:
+                        j = i
+                        while j < len(brute_mask) and brute_mask[j]:
+                            j += 1
+                        brute_intervals.append('{}\t{}\t{}\n'.format(name.decode(), i + 1, j))
+                        i = j
+                    else:
+                        i += 1
+            self.assertEqual(intervals.getvalue().decode(), ''.join(brute_intervals))
+
+    def testPrefilter(self):
+        for k in (1, 4, 7):
+            self.checkPrefilter(k)
+
+    def testPrefilterSmallBlocks(self):
+        # make sure k-mers spanning block boundaries are counted exactly once
+        for block_size in (1, 5, 16):
+            kmerPrefilter._BLOCK_SIZE = block_size
+            for k in (4, 7):
+                self.checkPrefilter(k)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -345,7 +345,7 @@ def get_leaves_and_outgroups(options, mc_tree, og_map, root):
 
 def get_generation_info():
     """ print a comment describing version and command line """
-    header = '## generated by : {}\n'.format(" ".join(map(shlex.quote, sys.argv)))
+    header = '## generated by : {}\n'.format(shlex.join(sys.argv))
     header += '## date : {}\n'.format(datetime.now())
     header += '## cactus commit : {}\n'.format(cactus_commit)
     return header
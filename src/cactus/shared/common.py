@@ -8,6 +8,7 @@
 import os
 import sys
 import shutil
+import gzip
 import subprocess
 import logging
 import pathlib
@@ -22,26 +23,34 @@ import threading
 import traceback
 import errno
 import shlex
+import itertools
+import collections
+import stat
+import re
+import functools
+import fcntl
+import io
 
 try:
     import boto3
     import botocore
+    import botocore.exceptions
+    from boto3.s3.transfer import TransferConfig
     has_s3 = True
 except:
     has_s3 = False
 
 from urllib.parse import urlparse
 from datetime import datetime
+from contextlib import contextmanager
 
 from toil.statsAndLogging import logger
-from toil.lib.bioio import system
 from toil.lib.bioio import getLogLevelString
 from toil.common import Toil
 from toil.job import Job
 from toil.realtimeLogger import RealtimeLogger
 from toil.lib.humanize import bytes2human, human2bytes
 from toil.lib.threading import cpu_count
-from sonLib.bioio import popenCatch
 from sonLib.bioio import getTempDirectory
 
 from cactus.shared.version import cactus_commit
@@ -49,8 +58,6 @@ from toil import physicalMemory
 
 _log = logging.getLogger(__name__)
 
-subprocess._has_poll = False
-
 def cactus_cpu_count():
     """ try the more cluster-friendly cpu counter before reverting to toil's
     https://github.com/ComparativeGenomicsToolkit/cactus/issues/820
@@ -120,65 +127,94 @@ def cactus_clamp_memory(memory_bytes):
     return max(min(int(os.environ['CACTUS_MAX_MEMORY']), int(memory_bytes)), int(os.environ['CACTUS_DEFAULT_MEMORY']))
 
 def makeURL(path_or_url):
-    if urlparse(path_or_url).scheme == '':
+    # without a ':' there can't be a scheme, so skip parsing plain local paths
+    if ':' not in path_or_url or urlparse(path_or_url).scheme == '':
         return "file://" + os.path.abspath(path_or_url)
     else:
         return path_or_url
 
+def _splice_concat(src_fd, dst_fd):
+    """Append everything readable from src_fd to dst_fd.  Uses sendfile where the
+    kernel supports it so the data never passes through user space.
+    """
+    if hasattr(os, 'sendfile'):
+        try:
+            while os.sendfile(dst_fd, src_fd, None, 1<<24) > 0:
+                pass
+            return
+        except OSError as e:
+            # only fall back if sendfile can't be used on these files at all
+            if e.errno not in (errno.EINVAL, errno.ENOSYS) or os.lseek(src_fd, 0, os.SEEK_CUR) != 0:
+                raise
+    while True:
+        buf = os.read(src_fd, 1<<20)
+        if not buf:
+            return
+        while buf:
+            buf = buf[os.write(dst_fd, buf):]
+
 def catFiles(filesToCat, catFile):
-    """Cats a bunch of files into one file. Ensures a no more than maxCat files
-    are concatenated at each step.
+    """Cats a bunch of files into one file.
     """
-    if len(filesToCat) == 0: #We must handle this case or the cat call will hang waiting for input
-        open(catFile, 'w').close()
-        return
-    maxCat = 25
-    system("cat %s > %s" % (" ".join(filesToCat[:maxCat]), catFile))
-    filesToCat = filesToCat[maxCat:]
-    while len(filesToCat) > 0:
-        system("cat %s >> %s" % (" ".join(filesToCat[:maxCat]), catFile))
-        filesToCat = filesToCat[maxCat:]
+    catFd = os.open(catFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        for fileToCat in filesToCat:
+            fileToCatFd = os.open(fileToCat, os.O_RDONLY)
+            try:
+                _splice_concat(fileToCatFd, catFd)
+            finally:
+                os.close(fileToCatFd)
+    finally:
+        os.close(catFd)
+
+_cactus_root = None
 
 def cactusRootPath():
     """
     function for finding external location
     """
-    import cactus
-    i = os.path.abspath(cactus.__file__)
-    return os.path.split(i)[0]
+    global _cactus_root
+    if _cactus_root is None:
+        import cactus
+        _cactus_root = os.path.dirname(os.path.abspath(cactus.__file__))
+    return _cactus_root
+
+_default_log_level = None
 
 def getLogLevelString2(logLevelString):
     """Gets the log level string for the binary
     """
-    if logLevelString == None:
-        return getLogLevelString()
-    return logLevelString
+    if logLevelString is not None:
+        return logLevelString
+    # toil's level doesn't change once the workflow is running, so only look it up once
+    global _default_log_level
+    if _default_log_level is None:
+        _default_log_level = getLogLevelString()
+    return _default_log_level
+
+_BOOL_ATTRIBS = {'false': False, 'true': True, '0': False, '1': True}
 
 def getOptionalAttrib(node, attribName, typeFn=None, default=None, errorIfNotPresent=False):
     """Get an optional attrib, or default if not set or node is None
     """
-    if node != None and attribName in node.attrib:
-        if typeFn != None:
-            if typeFn == bool:
-                aname = node.attrib[attribName].lower()
-                if aname == 'false':
-                    return False
-                elif aname == 'true':
-                    return True
-                else:
-                    return bool(int(node.attrib[attribName]))
-            return typeFn(node.attrib[attribName])
-        return node.attrib[attribName]
+    if node is not None and attribName in node.attrib:
+        value = node.attrib[attribName]
+        if typeFn is not None:
+            if typeFn is bool:
+                b = _BOOL_ATTRIBS.get(value.lower())
+                return b if b is not None else bool(int(value))
+            return typeFn(value)
+        return value
     if errorIfNotPresent:
-        raise RuntimeError("Could not find attribute %s in %s node" % (attribName, node))
+        raise RuntimeError(f"Could not find attribute {attribName} in {node} node")
     return default
 
 def findRequiredNode(configNode, nodeName):
     """Retrieve an xml node, complain if it's not there."""
     nodes = configNode.findall(nodeName)
-    if nodes == None:
-        raise RuntimeError("Could not find any nodes with name %s in %s node" % (nodeName, configNode))
-    assert len(nodes) == 1, "More than 1 node for %s in config XML" % nodeName
+    if not nodes:
+        raise RuntimeError(f"Could not find any nodes with name {nodeName} in {configNode} node")
+    assert len(nodes) == 1, f"More than 1 node for {nodeName} in config XML"
     return nodes[0]
 
 #############################################
@@ -203,29 +239,23 @@ def _fn(toilDir,
       logFile=None):
     logLevel = getLogLevelString2(logLevel)
     args = [toilDir, "--logLevel", logLevel]
-    if buildAvgs:
-        args += ["--buildAvgs"]
-    if buildHal:
-        args += ["--buildHal"]
-    if buildFasta:
-        args += ["--buildFasta"]
-    #Jobtree args
-    if batchSystem is not None:
-        args += ["--batchSystem", batchSystem]
-    if retryCount is not None:
-        args += ["--retryCount", str(retryCount)]
-    if rescueJobFrequency is not None:
-        args += ["--rescueJobFrequency", str(rescueJobFrequency)]
-    if toilStats:
-        args += ["--stats"]
-    if maxThreads is not None:
-        args += ["--maxThreads", str(maxThreads)]
-    if maxCpus is not None:
-        args += ["--maxCpus", str(maxCpus)]
-    if defaultMemory is not None:
-        args += ["--defaultMemory", str(defaultMemory)]
-    if logFile is not None:
-        args += ["--logFile", logFile]
+    # switches (True/False) are passed alone, other options (unless None) with their value
+    for flag, value in (("--buildAvgs", buildAvgs),
+                        ("--buildHal", buildHal),
+                        ("--buildFasta", buildFasta),
+                        #Jobtree args
+                        ("--batchSystem", batchSystem),
+                        ("--retryCount", retryCount),
+                        ("--rescueJobFrequency", rescueJobFrequency),
+                        ("--stats", toilStats),
+                        ("--maxThreads", maxThreads),
+                        ("--maxCpus", maxCpus),
+                        ("--defaultMemory", defaultMemory),
+                        ("--logFile", logFile)):
+        if value is True:
+            args.append(flag)
+        elif value is not None and value is not False:
+            args += [flag, str(value)]
     return args
 
 def runCactusWorkflow(experimentFile,
@@ -291,19 +321,31 @@ def runCactusProgressive(seqFile,
     runRealCactusProgressive(opts)
 
 def runToilStats(toil, outputFile):
-    system("toil stats %s --outputFile %s" % (toil, outputFile))
+    subprocess.check_call(["toil", "stats", toil, "--outputFile", outputFile])
     logger.info("Ran the job-tree stats command apparently okay")
 
 def runGetChunks(sequenceFiles, chunksDir, chunkSize, overlapSize, work_dir=None):
-    chunks = cactus_call(work_dir=work_dir,
-                         check_output=True,
-                         parameters=["faffy", "chunk",
-                                     "--logLevel", getLogLevelString(),
-                                     "--chunkSize", str(chunkSize),
-                                     "--overlap", str(overlapSize),
-                                     "--dir", chunksDir] + sequenceFiles)
-    return [chunk for chunk in chunks.split("\n") if chunk != ""]
-
+    """ Chunk up the sequence files, yielding the path of each chunk.
+    faffy's listing goes to a file next to chunksDir and is read back a line at a time, rather
+    than holding (potentially many thousands of) paths in one big string """
+    chunksList = chunksDir.rstrip('/') + '.list'
+    cactus_call(work_dir=work_dir,
+                outfile=chunksList,
+                parameters=["faffy", "chunk",
+                            "--logLevel", getLogLevelString2(None),
+                            "--chunkSize", str(chunkSize),
+                            "--overlap", str(overlapSize),
+                            "--dir", chunksDir] + sequenceFiles)
+    try:
+        with open(chunksList) as chunksFile:
+            for line in chunksFile:
+                chunk = line.rstrip('\n')
+                if chunk:
+                    yield chunk
+    finally:
+        os.remove(chunksList)
+
+@functools.lru_cache(maxsize=1)
 def getDockerOrg():
     """Get where we should find the cactus containers."""
     if "CACTUS_DOCKER_ORG" in os.environ:
@@ -311,6 +353,7 @@ def getDockerOrg():
     else:
         return "quay.io/comparative-genomics-toolkit"
 
+@functools.lru_cache(maxsize=2)
 def getDockerTag(gpu=False):
     """Get what docker tag we should use for the cactus image
     Default: latest release (which is all there is on quay these days)
@@ -323,49 +366,70 @@ def getDockerTag(gpu=False):
         # must be manually kept current with each release        
         return 'v2.9.3' + ('-gpu' if gpu else '')
 
+@functools.lru_cache(maxsize=2)
 def getDockerImage(gpu=False):
     """Get fully specified Docker image name."""
-    return "%s/cactus:%s" % (getDockerOrg(), getDockerTag())
+    return f"{getDockerOrg()}/cactus:{getDockerTag(gpu=gpu)}"
 
 def maxMemUsageOfContainer(containerInfo):
     """Return the max RSS usage (in bytes) of a container, or None if something failed."""
     if containerInfo['id'] is None:
-        # Try to get the internal container ID from the docker name
+        if containerInfo['cidfile'] is None:
+            return None
+        # docker writes the internal container ID to the cidfile once the container is created
         try:
-            id = popenCatch("docker inspect -f '{{.Id}}' %s" % containerInfo['name']).strip()
-            containerInfo['id'] = id
-        except:
+            with open(containerInfo['cidfile']) as cidfile:
+                containerInfo['id'] = cidfile.read().strip() or None
+        except IOError:
+            pass
+        if containerInfo['id'] is None:
             # Not yet running
             return None
     # Try to check for the maximum memory usage ever used by that
     # container, in a few different possible locations depending on
     # the distribution
-    possibleLocations = ["/sys/fs/cgroup/memory/docker/%s/memory.max_usage_in_bytes",
-                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes"]
-    possibleLocations = [s % containerInfo['id'] for s in possibleLocations]
-    for location in possibleLocations:
-        try:
-            with open(location) as f:
-                return int(f.read())
-        except IOError:
-            # Not at this location, or sysfs isn't mounted
-            continue
-    return None
+    if containerInfo.get('memfd') is None:
+        possibleLocations = [f"/sys/fs/cgroup/memory/docker/{containerInfo['id']}/memory.max_usage_in_bytes",
+                             f"/sys/fs/cgroup/memory/system.slice.docker-{containerInfo['id']}.scope/memory.max_usage_in_bytes"]
+        for location in possibleLocations:
+            try:
+                # keep it open: we'll be back every poll until the container exits
+                containerInfo['memfd'] = os.open(location, os.O_RDONLY)
+                break
+            except IOError:
+                # Not at this location, or sysfs isn't mounted
+                continue
+        else:
+            return None
+    try:
+        return int(os.pread(containerInfo['memfd'], 32, 0))
+    except (IOError, ValueError):
+        # the container (and its cgroup) went away
+        return None
 
 # send a time/date stamped message to the realtime logger, truncating it
 # if it's too long (so it's less likely to be dropped)
 def cactus_realtime_log(msg, max_len = 1500, log_debug=False):
+    if not cactus_realtime_log_enabled(log_debug):
+        return
     if len(msg) > max_len:
         msg = msg[:max_len-207] + " <...> " + msg[-200:]
     if not log_debug:
-        RealtimeLogger.info("{}: {}".format(datetime.now(), msg))
+        RealtimeLogger.info("%s: %s", datetime.now(), msg)
     else:
-        RealtimeLogger.debug("{}: {}".format(datetime.now(), msg))
+        RealtimeLogger.debug("%s: %s", datetime.now(), msg)
+
+def cactus_realtime_log_enabled(log_debug=False):
+    """ will cactus_realtime_log actually send anything? (so callers can skip building messages) """
+    return RealtimeLogger.getLogger().isEnabledFor(logging.DEBUG if log_debug else logging.INFO)
         
 def setupBinaries(options):
     """Ensure that Cactus's C/C++ components are ready to run, and set up the environment."""
     if options.latest:
         os.environ["CACTUS_USE_LATEST"] = "1"
+        # the docker helpers cache what they read from the environment
+        getDockerTag.cache_clear()
+        getDockerImage.cache_clear()
     if options.binariesMode is not None:
         # Mode is specified on command line
         mode = options.binariesMode
@@ -464,6 +528,33 @@ def importSingularityImage(options):
         else:
             logger.info("Using pre-built singularity image: '{}'".format(imgPath))
 
+@contextmanager
+def _flock(lock_path):
+    """ Hold an exclusive lock on lock_path (created if need be).  If the filesystem doesn't
+    support locking, carry on without it. """
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except OSError:
+            pass
+        try:
+            yield
+        finally:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except OSError:
+                pass
+
+_SINGULARITY_BASE = ('singularity', '--silent', 'exec', '-u')
+
+@functools.lru_cache(maxsize=1)
+def _default_singularity_dir():
+    return os.path.join(str(pathlib.Path.home()), '.singularity')
+
+# (tool, gpu, cache dir) -> sandbox directory, for images already known to be in the cache
+_singularity_sandboxes = {}
+_singularity_sandbox_lock = threading.Lock()
+
 def singularityCommand(tool=None,
                        work_dir=None,
                        parameters=None,
@@ -477,8 +568,6 @@ def singularityCommand(tool=None,
     if work_dir is None:
         work_dir = os.getcwd()
 
-    base_singularity_call = ['singularity', '--silent', 'exec']
-
     # Mount workdir as /mnt and work in there.
     # Hope the image actually has a /mnt available.
     # Otherwise this silently doesn't mount.
@@ -486,9 +575,9 @@ def singularityCommand(tool=None,
     # home at anything other than our real home (like something under /var
     # where Toil puts things).
     # Note that we target Singularity 3+.
-    base_singularity_call += ['-u', '-B', '{}:{}'.format(os.path.abspath(work_dir), '/mnt'), '--pwd', '/mnt']
+    base_singularity_call = [*_SINGULARITY_BASE, '-B', f'{os.path.abspath(work_dir)}:/mnt', '--pwd', '/mnt']
     if gpus:
-        base_singularity_call += ['--nv']
+        base_singularity_call.append('--nv')
     #todo: it seems like this would be useful (eg to hopefully limit squashfs resources) but it doesn't work
     #      on our cluster (crytpic cgroups errors)
     #if cpus:
@@ -509,9 +598,15 @@ def singularityCommand(tool=None,
         # and https://github.com/sylabs/singularity/issues/4555.
 
         # As a workaround, we have out own cache which we manage ourselves.
-        home_dir = str(pathlib.Path.home())
-        default_singularity_dir = os.path.join(home_dir, '.singularity')
-        cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR',  default_singularity_dir), 'toil')
+        cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR', _default_singularity_dir()), 'toil')
+
+        # sandboxes are never removed once made, so only resolve each one once per process
+        sandbox_key = (tool, bool(gpus), cache_dir)
+        with _singularity_sandbox_lock:
+            sandbox_dirname = _singularity_sandboxes.get(sandbox_key)
+        if sandbox_dirname is not None:
+            return base_singularity_call + [sandbox_dirname] + parameters
+
         os.makedirs(cache_dir, exist_ok=True)
 
         # hack to transform back to docker image
@@ -536,43 +631,79 @@ def singularityCommand(tool=None,
         sandbox_dirname = os.path.join(cache_dir, '{}.sandbox'.format(hashlib.sha256(tool.encode('utf-8')).hexdigest()))
 
         if not os.path.exists(sandbox_dirname):
-            # We atomically drop the sandbox at that name when we get it
-
-            # Make a temp directory to be the sandbox
-            temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
-
-            # Download with a fresh cache to a sandbox
-            download_env = os.environ.copy()
-            download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
-            build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
-
-            cactus_realtime_log("Running the command: \"{}\"".format(' '.join(build_cmd)))
-            start_time = time.time()
-            subprocess.check_call(build_cmd, env=download_env)
-            run_time = time.time() - start_time
-            cactus_realtime_log("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
+            # only one process on the machine downloads the image, the others wait for it
+            with _flock(sandbox_dirname + '.lock'):
+                if not os.path.exists(sandbox_dirname):
+                    # We atomically drop the sandbox at that name when we get it
+
+                    # Make a temp directory to be the sandbox
+                    temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
+
+                    # Download with a fresh cache to a sandbox
+                    download_env = os.environ.copy()
+                    download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
+                    build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
+
+                    cactus_realtime_log("Running the command: \"{}\"".format(' '.join(build_cmd)))
+                    start_time = time.time()
+                    subprocess.check_call(build_cmd, env=download_env)
+                    run_time = time.time() - start_time
+                    cactus_realtime_log("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
+
+                    # Clean up the Singularity cache since it is single use.  It can hold GBs
+                    # of layers, so in a job's temp dir (which toil removes anyway if we exit first)
+                    # do it in the background rather than hold up the first command
+                    if file_store:
+                        threading.Thread(target=shutil.rmtree, args=(download_env['SINGULARITY_CACHEDIR'],),
+                                         kwargs={'ignore_errors': True}, daemon=True).start()
+                    else:
+                        shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
+
+                    try:
+                        # This may happen repeatedly but it is atomic
+                        os.rename(temp_sandbox_dirname, sandbox_dirname)
+                    except OSError as e:
+                        if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                            # Can't rename a directory over another
+                            # Make sure someone else has made the directory
+                            assert os.path.exists(sandbox_dirname)
+                            # Remove our redundant copy
+                            shutil.rmtree(temp_sandbox_dirname)
+                        else:
+                            raise
+        with _singularity_sandbox_lock:
+            _singularity_sandboxes[sandbox_key] = sandbox_dirname
+        return base_singularity_call + [sandbox_dirname] + parameters
 
-            # Clean up the Singularity cache since it is single use
-            shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
 
-            try:
-                # This may happen repeatedly but it is atomic
-                os.rename(temp_sandbox_dirname, sandbox_dirname)
-            except OSError as e:
-                if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
-                    # Can't rename a directory over another
-                    # Make sure someone else has made the directory
-                    assert os.path.exists(sandbox_dirname)
-                    # Remove our redundant copy
-                    shutil.rmtree(temp_sandbox_dirname)
-                else:
-                    raise
-
-            # TODO: we could save some downloading by having one process download
-            # and the others wait, but then we would need a real fnctl locking
-            # system here.
-        return base_singularity_call + [sandbox_dirname] + parameters
+_resolv_conf_seen = False
 
+def _wait_for_resolv_conf():
+    """ This is really dumb, but we have to work around an intersection
+    between two bugs: one in CoreOS where /etc/resolv.conf is
+    sometimes missing temporarily, and one in Docker where it
+    refuses to start without /etc/resolv.conf.
+    Back off for up to ~50s rather than spinning, and don't check again once it's been seen.
+    """
+    global _resolv_conf_seen
+    if _resolv_conf_seen:
+        return
+    for attempt in range(10):
+        if os.path.exists('/etc/resolv.conf'):
+            _resolv_conf_seen = True
+            return
+        time.sleep(0.05 * 2 ** attempt)
+
+def releaseContainerInfo(containerInfo):
+    """Close the memory file and remove the cidfile that dockerCommand's containerInfo may hold."""
+    if containerInfo['memfd'] is not None:
+        os.close(containerInfo['memfd'])
+        containerInfo['memfd'] = None
+    if containerInfo['cidfile'] is not None:
+        try:
+            os.remove(containerInfo['cidfile'])
+        except OSError:
+            pass
 
 def dockerCommand(tool=None,
                   work_dir=None,
@@ -582,56 +713,66 @@ def dockerCommand(tool=None,
                   dockstore=None,
                   entrypoint=None,
                   gpus=None,
-                  cpus=None):
-    # This is really dumb, but we have to work around an intersection
-    # between two bugs: one in CoreOS where /etc/resolv.conf is
-    # sometimes missing temporarily, and one in Docker where it
-    # refuses to start without /etc/resolv.conf.
-    while not os.path.exists('/etc/resolv.conf'):
-        pass
+                  cpus=None,
+                  cidfile=True):
+    _wait_for_resolv_conf()
 
     base_docker_call = ['docker', 'run',
                         '--interactive',
                         '--net=host',
                         '--log-driver=none',
-                        '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                        '-u', f'{os.getuid()}:{os.getgid()}',
                         '-v', '{}:/data'.format(os.path.abspath(work_dir))]
+    extend = base_docker_call.extend
     if gpus:
         if 'SLURM_JOB_GPUS' in os.environ:
             # this allows slurm to identify which gpus are free
-            base_docker_call += ['--gpus', '"device={}"'.format(os.environ['SLURM_JOB_GPUS'])]            
-        else:                    
-            base_docker_call += ['--gpus', str(gpus)]
+            extend(('--gpus', '"device={}"'.format(os.environ['SLURM_JOB_GPUS'])))
+        else:
+            extend(('--gpus', str(gpus)))
     if cpus:
-        base_docker_call += ['--cpus', str(cpus)]
+        extend(('--cpus', str(cpus)))
 
-    if entrypoint is not None:
-        base_docker_call += ['--entrypoint', entrypoint]
-    else:
-        base_docker_call += ['--entrypoint', '/opt/cactus/wrapper.sh']
+    extend(('--entrypoint', entrypoint if entrypoint is not None else '/opt/cactus/wrapper.sh'))
 
     if port is not None:
-        base_docker_call += ["-p", "%d:%d" % (port, port)]
-
-    containerInfo = { 'name': str(uuid.uuid4()), 'id': None }
-    base_docker_call.extend(['--name', containerInfo['name']])
+        extend(("-p", f"{port:d}:{port:d}"))
+
+    container_name = str(uuid.uuid4())
+    containerInfo = { 'name': container_name, 'id': None, 'memfd': None,
+                      'cidfile': os.path.join(tempfile.gettempdir(), f'cactus-{container_name}.cid') if cidfile else None }
+    extend(('--name', container_name))
+    if cidfile:
+        # lets maxMemUsageOfContainer() find the container.  must be removed with releaseContainerInfo()
+        extend(('--cidfile', containerInfo['cidfile']))
     if rm:
         base_docker_call.append('--rm')
 
     docker_tag = getDockerTag(gpu=bool(gpus))
-    tool = "%s/%s:%s" % (dockstore, tool, docker_tag)
-    call = base_docker_call + [tool] + parameters
-    return call, containerInfo
+    base_docker_call.append(f"{dockstore}/{tool}:{docker_tag}")
+    extend(parameters)
+    return base_docker_call, containerInfo
 
 def prepareWorkDir(work_dir, parameters):
     if not work_dir:
         # Make sure all the paths we're accessing are in the same directory
-        files = [par for par in parameters if os.path.isfile(par)]
-        folders = [par for par in parameters if os.path.isdir(par)]
-        work_dirs = set([os.path.dirname(fileName) for fileName in files] + [os.path.dirname(folder) for folder in folders])
-        _log.info("Work dirs: %s" % work_dirs)
+        # (one stat per parameter, rather than separate isfile and isdir calls)
+        work_dirs = set()
+        for par in parameters:
+            try:
+                mode = os.stat(par).st_mode
+            except (OSError, ValueError):
+                continue
+            if stat.S_ISREG(mode) or stat.S_ISDIR(mode):
+                work_dirs.add(os.path.dirname(par))
+        _log.info("Work dirs: %s", work_dirs)
         if len(work_dirs) > 1:
-            work_dir = os.path.commonprefix(list(work_dirs))
+            # (commonprefix is character based: /foo/bar and /foo/baz would give /foo/ba)
+            try:
+                work_dir = os.path.commonpath(list(work_dirs))
+            except ValueError:
+                # a mix of absolute and relative paths: fall back to the current directory below
+                work_dir = ''
         elif len(work_dirs) == 1:
             work_dir = work_dirs.pop()
 
@@ -640,26 +781,91 @@ def prepareWorkDir(work_dir, parameters):
     #dir
     if work_dir is None or work_dir == '':
         work_dir = os.getcwd()
-    _log.info("Docker work dir: %s" % work_dir)
+    _log.info("Docker work dir: %s", work_dir)
 
     #We'll mount the work_dir containing the paths as /data in the container,
     #so set all the paths to their basenames. The container will access them at
     #/data/<path>
-    def adjustPath(path, wd):
+    if work_dir and work_dir != '.' and os.environ.get('CACTUS_DOCKER_MODE', 1) != "0":
+        wd = work_dir if work_dir.endswith('/') else work_dir + '/'
         # Hack to relativize paths that are not provided as a
         # single argument (i.e. multiple paths that are
-        # space-separated and quoted)
-        if wd != '.':
-            if not wd.endswith('/'):
-                wd = wd + '/'
-            return path.replace(wd, '')
-        else:
-            return path
-
-    if work_dir and os.environ.get('CACTUS_DOCKER_MODE', 1) != "0":
-        parameters = [adjustPath(par, work_dir) for par in parameters]
+        # space-separated and quoted, or --opt=path): only strip wd where it
+        # starts a path (possibly shell-quoted, as by shlex.join), not where it
+        # happens to appear in the middle of one
+        wd_re = re.compile(r'(?<![^\s=,:\'"])' + re.escape(wd))
+        parameters = [wd_re.sub('', par) if wd in par else par for par in parameters]
     return work_dir, parameters
 
+class _RusagePopen(subprocess.Popen):
+    """ Popen that reaps its child with wait4, keeping the child's resource usage in .rusage """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+def _drain_lines(fd, tail):
+    """ Read lines from fd until EOF, keeping the last ones in the tail deque, then close it """
+    with os.fdopen(fd, 'rb') as pipe:
+        for line in pipe:
+            tail.append(line)
+
+def _spawn_stage(command, **popen_args):
+    """ Start one stage of a pipeline.  A stage that can't be executed fails like it would in
+    bash (127 if it's not found, otherwise 126), rather than raising """
+    try:
+        return subprocess.Popen(command, **popen_args)
+    except OSError as e:
+        status, message = (127, 'command not found') if isinstance(e, FileNotFoundError) else (126, e.strerror)
+        return subprocess.Popen(['sh', '-c', 'echo "$0: $1" >&2; exit {}'.format(status), command[0], message],
+                                **popen_args)
+
+def _spawn_pipeline(commands, stdin, stdout, stderr, cwd, env):
+    """ Start the commands with each one's stdout feeding the next one's stdin, like a shell
+    pipeline.  Returns the last process and the list of the ones before it """
+    upstream = []
+    try:
+        for command in commands[:-1]:
+            proc = _spawn_stage(command, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr,
+                                cwd=cwd, env=env)
+            upstream.append(proc)
+            stdin = proc.stdout
+        last = _spawn_stage(commands[-1], stdin=stdin, stdout=stdout, stderr=stderr,
+                            cwd=cwd, env=env)
+    except:
+        for proc in upstream:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        # the children have their own copies; ours would stop upstream stages getting SIGPIPE
+        for proc in upstream:
+            proc.stdout.close()
+    return last, upstream
+
+def _memfd_stdin(data):
+    """ Return an anonymous in-memory file holding data, rewound for reading, or None if
+    the platform can't make one """
+    if not hasattr(os, 'memfd_create'):
+        return None
+    try:
+        memfd = os.fdopen(os.memfd_create('cactus-stdin'), 'w+b')
+    except OSError:
+        return None
+    memfd.write(data)
+    memfd.flush()
+    memfd.seek(0)
+    return memfd
+
+# memory line printed by the /usr/bin/time wrapper in cactus_call
+_MEM_LOG_RE = re.compile(r'CACTUS-LOGGED-MEMORY-IN-KB:\s*(\d+)')
+
 def cactus_call(tool=None,
                 work_dir=None,
                 parameters=None,
@@ -693,11 +899,16 @@ def cactus_call(tool=None,
         tool = "cactus"
     
     entrypoint = None
+    pipeline = None
     if (len(parameters) > 0) and isinstance(parameters[0], list):
         # We have a list of lists, which is the convention for commands piped into one another.
-        flattened = [i for sublist in parameters for i in sublist]
-        chain_params = [' '.join(p) for p in [list(map(shlex.quote, q)) for q in parameters]]
-        parameters = ['bash', '-c', 'set -eo pipefail && ' + ' | '.join(chain_params)]
+        if mode == "local" and not shell and not stdin_string and not returnStdErr and \
+           os.environ.get("CACTUS_LOG_MEMORY") is None:
+            # we can connect the processes ourselves and skip the bash shim (which is then
+            # only used to log the command)
+            pipeline = parameters
+        flattened = list(itertools.chain.from_iterable(parameters))
+        parameters = ['bash', '-c', 'set -eo pipefail && ' + ' | '.join(map(shlex.join, parameters))]
         if mode == "docker":
             # We want to shell into bash directly rather than going
             # through the default cactus entrypoint.
@@ -716,7 +927,9 @@ def cactus_call(tool=None,
                                             port=port,
                                             dockstore=dockstore,
                                             entrypoint=entrypoint,
-                                            gpus=gpus, cpus=cpus)
+                                            gpus=gpus, cpus=cpus,
+                                            # servers aren't polled for memory, so they don't need one
+                                            cidfile=not server)
     elif mode == "singularity":
         call = singularityCommand(tool=tool, work_dir=work_dir,
                                   parameters=parameters, port=port, file_store=fileStore,
@@ -725,38 +938,50 @@ def cactus_call(tool=None,
         assert mode == "local"
         call = parameters
 
-    if stdin_string:
+    # encoded once up front; the child only gets a stdin pipe when there's something to send
+    stdin_data = stdin_string.encode() if stdin_string else None
+    close_stdin = False
+    if stdin_data and len(stdin_data) > 1 << 20 and (memfd := _memfd_stdin(stdin_data)) is not None:
+        # the child reads big inputs itself, rather than communicate() pumping them down a pipe
+        stdinFileHandle, stdin_data, close_stdin = memfd, None, True
+    elif stdin_data:
         stdinFileHandle = subprocess.PIPE
     elif infile:
-        stdinFileHandle = open(infile, 'r')
+        # only the descriptors are handed to the child, which does its own buffering,
+        # so there's no point wrapping them in python text/buffer layers
+        stdinFileHandle = open(infile, 'rb', buffering=0)
+        close_stdin = True
     else:
         stdinFileHandle = subprocess.DEVNULL
     stdoutFileHandle = None
     if outfile:
-        stdoutFileHandle = open(outfile, 'a' if outappend else 'w')
+        stdoutFileHandle = open(outfile, 'ab' if outappend else 'wb', buffering=0)
     if check_output:
         stdoutFileHandle = subprocess.PIPE
 
-    _log.info("Running the command %s" % call)
+    _log.info("Running the command %s", call)
+    rt_log_debug = 'ktremotemgr' in call
+    rt_log_cmd = rt_log_cmd and cactus_realtime_log_enabled(rt_log_debug)
     if rt_log_cmd:
-        rt_message = 'Running the command: \"{}\"'.format(' '.join(call))
-        if features:
-            rt_message += ' (features={})'.format(features)    
-        cactus_realtime_log(rt_message, log_debug = 'ktremotemgr' in call)
+        feat_str = f' (features={features})' if features else ''
+        cactus_realtime_log(f'Running the command: "{" ".join(call)}"{feat_str}', log_debug = rt_log_debug)
 
     # hack to keep track of memory usage for single machine
     time_v = os.environ.get("CACTUS_LOG_MEMORY") is not None and 'ktserver' not in call and 'redis-server' not in call
 
-    # use /usr/bin/time -v to get peak memory usage
-    if time_v:
+    # use /usr/bin/time -v to get peak memory usage inside containers.  local processes are our
+    # own children, so we get it from their rusage when reaping them instead
+    time_wrap = time_v and mode != "local"
+    if time_wrap:
         if not shell:
             shell = True
-            call = ' '.join(shlex.quote(t) for t in call)
+            call = shlex.join(call)
         call = '/usr/bin/time -f "CACTUS-LOGGED-MEMORY-IN-KB: %M" {}'.format(call)
 
     # optionally pipe stderr (but only if realtime logging enabled)
     # note the check below if realtime logging is enabled is rather hacky
     pid = None
+    stderr_tail = stderr_thread = None
     if realtimeStderrPrefix and RealtimeLogger.getLogger().level < logging.CRITICAL:
         # Make our pipe
         rfd, wfd = os.pipe()
@@ -793,8 +1018,12 @@ def cactus_call(tool=None,
             mlwfile.close()
             # note that only call_directly below actually does anything with errfile at the moment
             errfile = wfile
-    else:
+    elif returnStdErr:
         errfile = subprocess.PIPE
+    else:
+        # only the end of stderr is ever looked at (error messages and the memory log line), so
+        # drain it in the background and keep a bounded tail rather than buffering all of it
+        stderr_rfd, errfile = os.pipe()
 
     # hack to keep tmp files local (required to run at all in some singularity setups where /tmp is not writable)
     sub_env = None
@@ -803,41 +1032,80 @@ def cactus_call(tool=None,
         sub_env['TMPDIR']='.'
         sub_env['TEMPDIR']='.'
 
-    process = subprocess.Popen(call, shell=shell, encoding=None,
-                               stdin=stdinFileHandle, stdout=stdoutFileHandle,
-                               stderr=errfile,
-                               bufsize=-1, cwd=work_dir, env=sub_env)
+    upstream = []
+    try:
+        if pipeline:
+            process, upstream = _spawn_pipeline(pipeline, stdin=stdinFileHandle, stdout=stdoutFileHandle,
+                                                stderr=errfile, cwd=work_dir, env=sub_env)
+        else:
+            popen = _RusagePopen if time_v and not time_wrap else subprocess.Popen
+            process = popen(call, shell=shell, encoding=None,
+                            stdin=stdinFileHandle, stdout=stdoutFileHandle,
+                            stderr=errfile, bufsize=-1, cwd=work_dir, env=sub_env)
+    except BaseException:
+        # nothing was started, so don't leak the descriptors opened for it
+        if not pid and not returnStdErr:
+            os.close(stderr_rfd)
+        if outfile:
+            stdoutFileHandle.close()
+        if close_stdin:
+            stdinFileHandle.close()
+        raise
+    finally:
+        # the child has its own copy of the write end of the stderr pipe
+        if not pid and not returnStdErr:
+            os.close(errfile)
+
+    if not pid and not returnStdErr:
+        stderr_tail = collections.deque(maxlen=2000)
+        stderr_thread = threading.Thread(target=_drain_lines, args=(stderr_rfd, stderr_tail), daemon=True)
+        stderr_thread.start()
 
     if server:
         return process
 
     memUsage = 0
-    first_run = True
     start_time = time.time()
     output = stderr = None  # used later to report errors
-    while True:
-        try:
-            # Wait a bit to see if the process is done
-            output, stderr = process.communicate(stdin_string.encode() if first_run and stdin_string else None, timeout=10)
-        except subprocess.TimeoutExpired:
-            if mode == "docker":
-                # Every so often, check the memory usage of the container
-                updatedMemUsage = maxMemUsageOfContainer(containerInfo)
-                if updatedMemUsage is not None:
-                    assert memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
-                    memUsage = updatedMemUsage
-            first_run = False
-            if soft_timeout is not None and time.time() - start_time > soft_timeout:
-                # Soft timeout has been triggered. Just return early.
-                process.send_signal(signal.SIGINT)
-                return None
-        else:
-            break
-    if mode == "docker" and job_name is not None and features is not None and fileStore is not None:
-        # Log a datapoint for the memory usage for these features.
-        fileStore.logToMaster("Max memory used for job %s (tool %s) "
-                              "on JSON features %s: %s" % (job_name, parameters[0],
-                                                           json.dumps(features), memUsage))
+    if mode != "docker" and soft_timeout is None:
+        # nothing to sample or time out on, so just block until the process is done
+        output, stderr = process.communicate(stdin_data)
+    else:
+        first_run = True
+        while True:
+            try:
+                # Wait a bit to see if the process is done
+                output, stderr = process.communicate(stdin_data if first_run else None, timeout=10)
+            except subprocess.TimeoutExpired:
+                if mode == "docker":
+                    # Every so often, check the memory usage of the container
+                    updatedMemUsage = maxMemUsageOfContainer(containerInfo)
+                    if updatedMemUsage is not None:
+                        assert memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
+                        memUsage = updatedMemUsage
+                first_run = False
+                if soft_timeout is not None and time.time() - start_time > soft_timeout:
+                    # Soft timeout has been triggered. Just return early.
+                    process.send_signal(signal.SIGINT)
+                    if mode == "docker":
+                        releaseContainerInfo(containerInfo)
+                    return None
+            else:
+                break
+    # like pipefail: the pipeline's status is that of the last stage to fail
+    if process.returncode == 0:
+        for proc in reversed(upstream):
+            if proc.wait() != 0:
+                process.returncode = proc.returncode
+                break
+    for proc in upstream:
+        proc.wait()
+    if mode == "docker":
+        releaseContainerInfo(containerInfo)
+    if mode == "docker" and job_name is not None and features and fileStore is not None and memUsage:
+        # Log a datapoint for the memory usage for these features (skipped if it was never sampled).
+        fileStore.logToMaster(f"Max memory used for job {job_name} (tool {parameters[0]}) "
+                              f"on JSON features {json.dumps(features)}: {memUsage}")
 
     mem_log_line = None
     if pid and pid > 0:
@@ -850,7 +1118,13 @@ def cactus_call(tool=None,
         mem_log_line = mlrfile.readline().strip().decode()
         mlrfile.close()        
         os.wait()
+    if getattr(process, 'rusage', None) is not None:
+        # ru_maxrss is in KB on linux, same as /usr/bin/time's %M
+        mem_log_line = f'CACTUS-LOGGED-MEMORY-IN-KB: {process.rusage.ru_maxrss}'
 
+    if stderr_thread is not None:
+        stderr_thread.join()
+        stderr = b''.join(stderr_tail)
     if stderr is not None:
         stderr = stderr.decode()
     if output is not None:
@@ -858,34 +1132,30 @@ def cactus_call(tool=None,
 
     if outfile:
         stdoutFileHandle.close()
+    if close_stdin:
+        stdinFileHandle.close()
         
     if process.returncode == 0 and rt_log_cmd:
         run_time = time.time() - start_time
-        if time_v:
+        if time_wrap:
             call = call[len('/usr/bin/time -f "CACTUS-LOGGED-MEMORY-IN-KB: %M" '):]
-        rt_message = "Successfully ran{}\"{}\"".format(' ' + realtimeStderrPrefix + ': ' if realtimeStderrPrefix else ': ',
-                                                         ' '.join(call) if not shell else call)
-        if features:
-            rt_message += ' (features={})'.format(features)
-        rt_message += " in {} seconds".format(round(run_time, 4))
-        utilization = None
+        mem_str = util_str = ''
         if time_v:
-            if stderr:
-                for line in stderr.split('\n'):
-                    if 'CACTUS-LOGGED-MEMORY-IN-KB:' in line:
-                        mem_log_line = line
-                        break
-            if mem_log_line:
-                mem_bytes = int(mem_log_line.split()[-1]) * 1024
-                rt_message += ' and {} memory'.format(bytes2human(mem_bytes))
+            mem_match = _MEM_LOG_RE.search(mem_log_line) if mem_log_line else None
+            if not mem_match and stderr and time_wrap:
+                mem_match = _MEM_LOG_RE.search(stderr)
+            if mem_match:
+                mem_bytes = int(mem_match.group(1)) * 1024
+                mem_str = f' and {bytes2human(mem_bytes)} memory'
                 if job_memory:
                     utilization = float(mem_bytes) / job_memory
-        if job_memory:
-            rt_message += ' with job-memory {}'.format(bytes2human(job_memory))
-        if utilization:
-            rt_message += '. Percent utilization: {:.4}{}'.format(100. * utilization, ' **WARNING: limit exceeded**' if utilization > 1 else '')
-                
-        cactus_realtime_log(rt_message, log_debug = 'ktremotemgr' in call)
+                    if utilization:
+                        util_str = f'. Percent utilization: {100. * utilization:.4}{" **WARNING: limit exceeded**" if utilization > 1 else ""}'
+        job_mem_str = f' with job-memory {bytes2human(job_memory)}' if job_memory else ''
+        prefix_str = f' {realtimeStderrPrefix}: ' if realtimeStderrPrefix else ': '
+        cmd_str = call if shell else ' '.join(call)
+        rt_message = f'Successfully ran{prefix_str}"{cmd_str}"{feat_str} in {run_time:.4f} seconds{mem_str}{job_mem_str}{util_str}'
+        cactus_realtime_log(rt_message, log_debug = rt_log_debug)
 
     if check_result:
         return process.returncode
@@ -965,15 +1235,14 @@ class RoundedJob(Job):
         >>> j = RoundedJob()
         >>> j.roundingAmount = 100000000
         >>> j.roundUp(1000)
-        10000000
+        100000000
         >>> j.roundUp(200000000)
         200000000
         >>> j.roundUp(200000001)
         300000000
         """
-        if bytesRequirement % self.roundingAmount == 0:
-            return bytesRequirement
-        return (bytesRequirement // self.roundingAmount + 1) * self.roundingAmount
+        roundingAmount = self.roundingAmount
+        return -(-bytesRequirement // roundingAmount) * roundingAmount
 
     def _runner(self, *args, jobStore=None, fileStore=None, **kwargs):
         # We aren't supposed to override this. Toil can change the signature at
@@ -996,6 +1265,17 @@ def readGlobalFileWithoutCache(fileStore, jobStoreID):
     fileStore.jobStore.readFile(jobStoreID, f)
     return f
 
+def _child_tree_fanout(num_children):
+    """ The default ChildTreeJob fan-out: up to 400 children are added directly, more are
+    spread over two levels of ~sqrt(n) jobs each, keeping the number of serial jobStore
+    writes per job down without adding levels.  CACTUS_CHILDTREE_FANOUT overrides it.
+    """
+    if 'CACTUS_CHILDTREE_FANOUT' in os.environ:
+        return max(2, int(os.environ['CACTUS_CHILDTREE_FANOUT']))
+    if num_children <= 400:
+        return max(1, num_children)
+    return math.isqrt(num_children - 1) + 1
+
 class ChildTreeJob(RoundedJob):
     """Spreads the child-job initialization work among multiple jobs.
 
@@ -1004,9 +1284,12 @@ class ChildTreeJob(RoundedJob):
     fashion). Subclasses of this job will automatically spread out
     that work amongst a tree of jobs, increasing the total work done
     slightly, but reducing the wall-clock time taken dramatically.
+
+    By default (maxChildrenPerJob=None) the fan-out is picked from the
+    number of children, see _child_tree_fanout().
     """
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None,
-                 unitName=None, checkpoint=False, maxChildrenPerJob=20):
+                 unitName=None, checkpoint=False, maxChildrenPerJob=None):
         self.queuedChildJobs = []
         self.maxChildrenPerJob = maxChildrenPerJob
         super(ChildTreeJob, self).__init__(memory=memory, cores=cores, disk=disk,
@@ -1014,6 +1297,8 @@ class ChildTreeJob(RoundedJob):
                                            checkpoint=checkpoint)
 
     def addChild(self, job):
+        # children are only queued here, and linked into the tree in _run().  list.append
+        # is atomic, so this is safe to call from several threads of run() without a lock
         self.queuedChildJobs.append(job)
         return job
 
@@ -1028,116 +1313,167 @@ class ChildTreeJob(RoundedJob):
         ret = super(ChildTreeJob, self)._run(*args, **kwargs)
 
         # Now we can do our actual work.
-        if len(self.queuedChildJobs) <= self.maxChildrenPerJob:
+        children = self.queuedChildJobs
+        num_children = len(children)
+        max_children = self.maxChildrenPerJob
+        if max_children is None:
+            max_children = _child_tree_fanout(num_children)
+        add_to_self = super(ChildTreeJob, self).addChild
+        if num_children <= max_children:
             # The number of children is small enough that we can just
             # add them directly.
-            for childJob in self.queuedChildJobs:
-                super(ChildTreeJob, self).addChild(childJob)
+            for childJob in children:
+                add_to_self(childJob)
         else:
             # Too many children, so we have to build a tree to avoid
             # bottlenecking on consistently serializing all the jobs.
 
-            # compute the number of levels (after root) of our job tree
-            num_levels = math.floor(math.log(len(self.queuedChildJobs), self.maxChildrenPerJob))
+            # compute the number of levels (after root) of our job tree: just enough
+            # for the last one to have room for all the leaves (computed exactly, as
+            # floor(log(n, k)) can be off by one due to rounding)
+            num_levels = 1
+            while max_children ** (num_levels + 1) < num_children:
+                num_levels += 1
 
             # fill out all the internal nodes of the tree, where the root is self
             # they will be empty RoundedJobs
             prev_level = [self]
-            level = []
             for i in range(num_levels):
+                level = []
                 for parent_job in prev_level:
                     # with this check, we allow a partial split of the last level
                     # to account for rounding
-                    if len(level) * self.maxChildrenPerJob < len(self.queuedChildJobs):
-                        for j in range(self.maxChildrenPerJob):
-                            child_job = RoundedJob()
-                            if parent_job is self:
-                                super(ChildTreeJob, self).addChild(child_job)
-                            else:
-                                parent_job.addChild(child_job)
-                            level.append(child_job)
+                    if len(level) * max_children < num_children:
+                        new_jobs = [RoundedJob() for j in range(max_children)]
+                        parent_add = add_to_self if parent_job is self else parent_job.addChild
+                        for child_job in new_jobs:
+                            parent_add(child_job)
+                        level.extend(new_jobs)
                     else:
                         level.append(parent_job)
-
                 prev_level = level
-                level = []
 
             # add the leaves.  these will be the jobs in self.queuedChildJobs
             leaves_added = 0
             for parent_job in prev_level:
-                num_children = min(len(self.queuedChildJobs) - leaves_added, self.maxChildrenPerJob)
-                for j in range(num_children):
-                    if parent_job is self:
-                        super(ChildTreeJob, self).addChild(self.queuedChildJobs[leaves_added])
-                    else:
-                        parent_job.addChild(self.queuedChildJobs[leaves_added])
-                    leaves_added += 1
-            assert leaves_added == len(self.queuedChildJobs)
+                parent_add = add_to_self if parent_job is self else parent_job.addChild
+                for child_job in children[leaves_added:leaves_added + max_children]:
+                    parent_add(child_job)
+                leaves_added = min(leaves_added + max_children, num_children)
+            assert leaves_added == num_children
 
         return ret
 
 def dumpStacksHandler(signal, frame):
     """Signal handler to print the stacks of all threads to stderr"""
+    # snapshot the frames first so every thread in them is still in the enumerate()
+    frames = sys._current_frames()
+    id2name = {th.ident: th.name for th in threading.enumerate()}
+    # format everything up front and write it at once so it doesn't interleave with other output
+    buf = io.StringIO()
+    print("###### stack traces {} ######".format(datetime.now().isoformat()), file=buf)
+    for threadId, stack in frames.items():
+        print("# Thread: {}({})".format(id2name.get(threadId,""), threadId), file=buf)
+        traceback.print_stack(f=stack, file=buf)
+    print("\n", file=buf)
     fh = sys.stderr
-    print("###### stack traces {} ######".format(datetime.now().isoformat()), file=fh)
-    id2name = dict([(th.ident, th.name) for th in threading.enumerate()])
-    for threadId, stack in sys._current_frames().items():
-        print("# Thread: {}({})".format(id2name.get(threadId,""), threadId), file=fh)
-        traceback.print_stack(f=stack, file=fh)
-    print("\n", file=fh)
+    fh.write(buf.getvalue())
     fh.flush()
 
 def enableDumpStack(sig=signal.SIGUSR1):
     """enable dumping stacks when the specified signal is received"""
     signal.signal(sig, dumpStacksHandler)
 
+# unzip_gzs/zip_gzs group small files into child jobs of up to this many files and bytes (of
+# input), so that many tiny files don't each cost a job.  anything bigger gets a job to itself,
+# as whole assemblies are much better (un)zipped in parallel
+_GZ_BATCH_SIZE = 20
+_GZ_BATCH_BYTES = 100*1024*1024
+
+def _gz_batches(items, sizes):
+    """ split items (in order) into lists to (un)zip in one job, by the sizes of their files """
+    batch, batch_bytes = [], 0
+    for item, size in zip(items, sizes):
+        if batch and (len(batch) == _GZ_BATCH_SIZE or batch_bytes + size > _GZ_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+# extensions of the files that unzip_gzs treats as gzipped (bgzip output is valid gzip).  zip_gzs
+# only writes .gz, as the gzip module doesn't write the BGZF that htslib expects of .bgz files
+_GZ_SUFFIXES = ('.gz', '.bgz')
+
 def unzip_gzs(job, input_paths, input_ids, delete_original=True):
-    """ go through a list of files and unzip any that end with .gz and return a list 
+    """ go through a list of files and unzip any that end with .gz (or .bgz) and return a list 
     of updated ids.  files that don't end in .gz are just passed through.  relying on the extension
-    is pretty fragile but better than nothing """
-    unzipped_ids = []
-    for input_path, input_id in zip(input_paths, input_ids):
-        if input_path.endswith('.gz'):
-            unzip_job = job.addChildJobFn(unzip_gz, input_path, input_id, delete_original=delete_original,
-                                          disk=10*input_id.size)
-            unzipped_ids.append(unzip_job.rv())
-        else:
-            unzipped_ids.append(input_id)
+    is pretty fragile but better than nothing.  small files are unzipped in batches, rather than a job per file """
+    unzipped_ids = list(input_ids[:len(input_paths)])
+    to_unzip = [i for i, input_path in enumerate(input_paths[:len(unzipped_ids)]) if input_path.endswith(_GZ_SUFFIXES)]
+    for batch in _gz_batches(to_unzip, [input_ids[i].size for i in to_unzip]):
+        unzip_job = job.addChildJobFn(unzip_gz_batch, [input_paths[i] for i in batch], [input_ids[i] for i in batch],
+                                      delete_original=delete_original,
+                                      disk=sum(10*input_ids[i].size for i in batch))
+        for k, i in enumerate(batch):
+            unzipped_ids[i] = unzip_job.rv(k)
     return unzipped_ids
 
+def unzip_gz_batch(job, input_paths, input_ids, delete_original=True):
+    """ unzip a list of files, returning the list of unzipped ids """
+    return [unzip_gz(job, input_path, input_id, delete_original=delete_original)
+            for input_path, input_id in zip(input_paths, input_ids)]
+
 def unzip_gz(job, input_path, input_id, delete_original=True):
     """ unzip a single file """
     work_dir = job.fileStore.getLocalTempDir()
-    assert input_path.endswith('.gz')
+    assert input_path.endswith(_GZ_SUFFIXES)
     fa_path = os.path.join(work_dir, os.path.basename(input_path))
-    job.fileStore.readGlobalFile(input_id, fa_path)
-    out_fa_path = fa_path[:-3]
-    cactus_call(parameters=['gzip', '-dc', os.path.basename(fa_path)], work_dir=work_dir, outfile=out_fa_path)
+    # the input is only read, so let toil link it in rather than copy it where it can
+    job.fileStore.readGlobalFile(input_id, fa_path, symlink=True)
+    out_fa_path = os.path.splitext(fa_path)[0]
+    with gzip.open(fa_path, 'rb') as in_file, open(out_fa_path, 'wb') as out_file:
+        shutil.copyfileobj(in_file, out_file, 1<<20)
     if delete_original:
         job.fileStore.deleteGlobalFile(input_id)
-    return job.fileStore.writeGlobalFile(fa_path[:-3])
+    return job.fileStore.writeGlobalFile(out_fa_path)
 
 def zip_gzs(job, input_paths, input_ids, list_elems = None, delete_original=True):
     """ zip up some files.  the input_ids can be a list of lists.  if it is, then list_elems
-    can be used to only zip a subset (leaving everything else) on each list."""
+    can be used to only zip a subset (leaving everything else) on each list.  small files
+    are zipped in batches, rather than a job per file """
     zipped_ids = []
+    # (path, id, index in zipped_ids, index in sublist or None) of everything to zip
+    to_zip = []
+    list_elems = set(list_elems) if list_elems else None
     for input_path, input_list in zip(input_paths, input_ids):
         if input_path.endswith('.gz'):
-            if isinstance(input_list, list) or isinstance(input_list, tuple):
-                output_list = []
+            if isinstance(input_list, (list, tuple)):
+                output_list = list(input_list)
                 for i, elem in enumerate(input_list):
-                    if not list_elems or i in list_elems:
-                        output_list.append(job.addChildJobFn(zip_gz, input_path, elem, delete_original=delete_original,
-                                                             disk=2*elem.size).rv())
-                    else:
-                        output_list.append(elem)
+                    if list_elems is None or i in list_elems:
+                        to_zip.append((input_path, elem, len(zipped_ids), i))
                 zipped_ids.append(output_list)
             else:
-                zipped_ids.append(job.addChildJobFn(zip_gz, input_path, input_list, delete_original=delete_original,
-                                                    disk=2*input_list.size).rv())
+                to_zip.append((input_path, input_list, len(zipped_ids), None))
+                zipped_ids.append(input_list)
         else:
             zipped_ids.append(input_list)
+    for batch in _gz_batches(to_zip, [item[1].size for item in to_zip]):
+        zip_job = job.addChildJobFn(zip_gz_batch, [item[0] for item in batch], [item[1] for item in batch],
+                                    delete_original=delete_original,
+                                    disk=sum(2*item[1].size for item in batch))
+        for k, (_, _, i, j) in enumerate(batch):
+            if j is None:
+                zipped_ids[i] = zip_job.rv(k)
+            else:
+                zipped_ids[i][j] = zip_job.rv(k)
     return zipped_ids
+
+def zip_gz_batch(job, input_paths, input_ids, delete_original=True):
+    """ zip a list of files, returning the list of zipped ids """
+    return [zip_gz(job, input_path, input_id, delete_original=delete_original)
+            for input_path, input_id in zip(input_paths, input_ids)]
     
 def zip_gz(job, input_path, input_id, delete_original=True):
     """ zip a single file """
@@ -1145,9 +1481,11 @@ def zip_gz(job, input_path, input_id, delete_original=True):
     fa_path = os.path.join(work_dir, os.path.basename(input_path))
     if fa_path.endswith('.gz'):
         fa_path = fa_path[:-3]
-    job.fileStore.readGlobalFile(input_id, fa_path)
+    job.fileStore.readGlobalFile(input_id, fa_path, symlink=True)
     out_fa_path = fa_path + '.gz'
-    cactus_call(parameters=['gzip', '-c', os.path.basename(fa_path)], work_dir=work_dir, outfile=out_fa_path)
+    # level 6 is what the gzip command line uses (python's default is the much slower 9)
+    with open(fa_path, 'rb') as in_file, gzip.open(out_fa_path, 'wb', compresslevel=6) as out_file:
+        shutil.copyfileobj(in_file, out_file, 1<<20)
     if delete_original:
         job.fileStore.deleteGlobalFile(input_id)
     return job.fileStore.writeGlobalFile(out_fa_path)
@@ -1159,26 +1497,40 @@ def get_aws_region(full_path):
     else:
         return None
 
+# the s3 client (and buckets known to exist) are kept for every write_s3 in the process
+_s3_client = None
+_s3_buckets_checked = set()
+
 def write_s3(local_path, s3_path, region=None):
     """ cribbed from toil-vg.  more convenient just to throw hal output on s3
     than pass it as a promise all the way back to the start job to export it locally """
+    global _s3_client
     assert s3_path.startswith('s3://')
     bucket_name, name_prefix = s3_path[5:].split("/", 1)
-    botocore_session = botocore.session.get_session()
-    botocore_session.get_component('credential_provider').get_provider('assume-role').cache = botocore.credentials.JSONFileCache()
-    boto3_session = boto3.Session(botocore_session=botocore_session)
-
-    # Connect to the s3 bucket service where we keep everything
-    s3 = boto3_session.client('s3')
-    try:
-        s3.head_bucket(Bucket=bucket_name)
-    except:
-        if region:
-            s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint':region})
-        else:
-            s3.create_bucket(Bucket=bucket_name)
+    if _s3_client is None:
+        botocore_session = botocore.session.get_session()
+        botocore_session.get_component('credential_provider').get_provider('assume-role').cache = botocore.credentials.JSONFileCache()
+        boto3_session = boto3.Session(botocore_session=botocore_session)
+
+        # Connect to the s3 bucket service where we keep everything
+        _s3_client = boto3_session.client('s3')
+    s3 = _s3_client
+    if bucket_name not in _s3_buckets_checked:
+        try:
+            s3.head_bucket(Bucket=bucket_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchBucket'):
+                raise
+            if region:
+                s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint':region})
+            else:
+                s3.create_bucket(Bucket=bucket_name)
+        _s3_buckets_checked.add(bucket_name)
 
-    s3.upload_file(local_path, bucket_name, name_prefix)
+    # big (hal) files are uploaded as parallel multipart transfers
+    s3.upload_file(local_path, bucket_name, name_prefix,
+                   Config=TransferConfig(multipart_threshold=64*1024*1024, multipart_chunksize=32*1024*1024,
+                                         max_concurrency=min(10, os.cpu_count() or 1), use_threads=True))
 
 def get_faidx_subpath_rename_cmd():
     """
@@ -1,5 +1,7 @@
 import os
+import shlex
 import shutil
+import subprocess
 import unittest
 from base64 import b64encode
 
@@ -9,7 +11,7 @@ from sonLib.bioio import getTempDirectory
 from sonLib.bioio import system
 from toil.job import Job
 from toil.common import Toil
-from cactus.shared.common import cactus_call, ChildTreeJob
+from cactus.shared.common import cactus_call, ChildTreeJob, _gz_batches
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -58,6 +60,56 @@ class TestCase(unittest.TestCase):
                              check_output=True)
         self.assertEqual(output, 'quuxbazbar\n')
 
+    @TestStatus.shortLength
+    def testCactusCallLocalPipes(self):
+        """In local mode, piped commands are connected directly rather than through bash, so check
+        that they behave like the bash pipeline with pipefail."""
+        inputFile = getTempFile(rootDir=self.tempDir)
+        with open(inputFile, 'w') as f:
+            f.write('foobar\nfoo\nbar\n' * 1000)
+        pipelines = [[['cat', inputFile], ['sed', 's/foo/baz/g'], ['awk', '{ print "quux" $0 }']],
+                     [['cat', inputFile], ['sort'], ['uniq', '-c']],
+                     [['seq', '1000'], ['tail', '-n', '3']]]
+        failures = [([['false'], ['cat']], 1),
+                    ([['cat', inputFile], ['sh', '-c', 'cat > /dev/null; exit 3'], ['cat']], 3),
+                    # the rightmost failure is the one reported
+                    ([['sh', '-c', 'exit 2'], ['sh', '-c', 'cat; exit 5'], ['cat']], 5),
+                    ([['sh', '-c', 'exit 2'], ['cat'], ['sh', '-c', 'cat; exit 7']], 7),
+                    # missing executables fail like they do in bash rather than raising
+                    ([['cat', inputFile], ['cactus_no_such_binary'], ['cat']], 127),
+                    ([['cactus_no_such_binary', inputFile], ['cat']], 127),
+                    ([['cat', inputFile], ['cactus_no_such_binary']], 127)]
+
+        mode = os.environ.get('CACTUS_BINARIES_MODE')
+        os.environ['CACTUS_BINARIES_MODE'] = 'local'
+        try:
+            for pipeline in pipelines:
+                expected = subprocess.check_output(['bash', '-c', 'set -eo pipefail && ' + ' | '.join(map(shlex.join, pipeline))])
+                self.assertEqual(cactus_call(parameters=pipeline, check_output=True), expected.decode())
+            for pipeline, returncode in failures:
+                bash_returncode = subprocess.call(['bash', '-c', 'set -eo pipefail && ' + ' | '.join(map(shlex.join, pipeline))])
+                self.assertEqual(bash_returncode, returncode)
+                self.assertEqual(cactus_call(parameters=pipeline, check_result=True), returncode)
+                with self.assertRaises(RuntimeError) as cm:
+                    cactus_call(parameters=pipeline)
+                if returncode == 127:
+                    self.assertIn('command not found', str(cm.exception))
+        finally:
+            if mode is None:
+                del os.environ['CACTUS_BINARIES_MODE']
+            else:
+                os.environ['CACTUS_BINARIES_MODE'] = mode
+
+    @TestStatus.shortLength
+    def testGzBatches(self):
+        """Small files are (un)zipped together, big ones each get their own job."""
+        MB = 1024 * 1024
+        self.assertEqual(list(_gz_batches('abcdefg', [3*MB, 5*MB, 2000*MB, 1*MB, 99*MB, 2*MB, 2*MB])),
+                         [['a', 'b'], ['c'], ['d', 'e'], ['f', 'g']])
+        self.assertEqual([len(batch) for batch in _gz_batches(range(45), [1] * 45)], [20, 20, 5])
+        self.assertEqual(list(_gz_batches('abc', [4000*MB] * 3)), [['a'], ['b'], ['c']])
+        self.assertEqual(list(_gz_batches([], [])), [])
+
     @TestStatus.mediumLength
     def testChildTreeJob(self):
         """Check that the ChildTreeJob class runs all children."""
@@ -75,11 +127,23 @@ class TestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
         shutil.rmtree(flagDir)
 
+        # 100 children are added directly by default, so force a tree too
+        flagDir = getTempDirectory()
+        options = Job.Runner.getDefaultOptions(getTempDirectory())
+        shutil.rmtree(options.jobStore)
+
+        with Toil(options) as toil:
+            toil.start(CTTestParent(flagDir, numChildren, maxChildrenPerJob=7))
+
+        for i in range(numChildren):
+            self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
+        shutil.rmtree(flagDir)
+
 class CTTestParent(ChildTreeJob):
-    def __init__(self, flagDir, numChildren):
+    def __init__(self, flagDir, numChildren, maxChildrenPerJob=None):
         self.flagDir = flagDir
         self.numChildren = numChildren
-        super(CTTestParent, self).__init__()
+        super(CTTestParent, self).__init__(maxChildrenPerJob=maxChildrenPerJob)
 
     def run(self, fileStore):
         for i in range(self.numChildren):
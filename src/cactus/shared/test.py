@@ -8,14 +8,13 @@ cactus workflow and the various utilities.
 """
 
 import os
+import math
 import random
 import xml.etree.ElementTree as ET
 
 from sonLib.bioio import logger
 from sonLib.bioio import getTempFile
 from sonLib.bioio import getTempDirectory
-from sonLib.bioio import getRandomSequence
-from sonLib.bioio import mutateSequence
 from sonLib.bioio import reverseComplement
 from sonLib.bioio import fastaRead, fastaWrite
 from sonLib.bioio import printBinaryTree
@@ -115,6 +114,54 @@ def getCactusWorkflowExperimentForTest(testId, sequences, newickTreeString, outp
 #Stuff for getting random inputs to a test
 ###############
 
+def _geometric(prob):
+    """Number of failures before the first success of a trial with the given probability.
+    """
+    return int(math.log(1.0 - random.random()) / math.log(1.0 - prob))
+
+def _eventPositions(length, prob):
+    """Positions in [0, length) where an event of the given per-base probability occurs,
+    found by skipping ahead rather than rolling for every base.
+    """
+    positions = []
+    if prob > 0:
+        i = _geometric(prob)
+        while i < length:
+            positions.append(i)
+            i += 1 + _geometric(prob)
+    return positions
+
+def _getRandomSequence(length):
+    """Same distribution as sonLib's getRandomSequence()[1] (including its random length),
+    but drawn in one go instead of a base at a time.
+    """
+    return "".join(random.choices('ACTGACTGACTGACTGACTGN', k=int(random.random() * length)))
+
+def _mutateSequence(seq, distance):
+    """Same model as sonLib's mutateSequence (substitutions at rate distance, short insertions
+    and deletions each at 5% of that), but only visiting the mutated positions.
+    """
+    bases = list(seq)
+    for i in _eventPositions(len(bases), distance):
+        bases[i] = random.choice('ACTG')
+    seq = "".join(bases)
+    indels = sorted([(i, True) for i in _eventPositions(len(seq), 0.05 * distance)] +
+                    [(i, False) for i in _eventPositions(len(seq), 0.05 * distance)])
+    l = []
+    prev = 0
+    for i, insertion in indels:
+        if i < prev:
+            # already deleted
+            continue
+        l.append(seq[prev:i+1])
+        prev = i + 1
+        if insertion:
+            l.append(_getRandomSequence(_geometric(0.1)))
+        else:
+            prev += _geometric(0.1)
+    l.append(seq[prev:])
+    return "".join(l)
+
 def getCactusInputs_random(regionNumber=0, tempDir=None,
                            sequenceNumber=None,
                            avgSequenceLength=None,
@@ -132,18 +179,13 @@ def getCactusInputs_random(regionNumber=0, tempDir=None,
     #Make tree
     binaryTree = makeRandomBinaryTree(treeLeafNumber)
     newickTreeString = printBinaryTree(binaryTree, includeDistances=True)
-    newickTreeLeafNames = []
-    def fn(tree):
-        if tree.internal:
-            fn(tree.left)
-            fn(tree.right)
-        else:
-            newickTreeLeafNames.append(tree.iD)
-    fn(binaryTree)
+    # we only need the number of leaves, which in a binary tree is one more than the
+    # number of internal nodes (ie commas in the newick string)
+    leafNumber = newickTreeString.count(',') + 1
     logger.info("Made random binary tree: %s" % newickTreeString)
 
     sequenceDirs = []
-    for i in range(len(newickTreeLeafNames)):
+    for i in range(leafNumber):
         seqDir = getTempDirectory(rootDir=tempDir)
         sequenceDirs.append(seqDir)
 
@@ -152,7 +194,7 @@ def getCactusInputs_random(regionNumber=0, tempDir=None,
     #Random sequences and species labelling
     sequenceFile = None
     fileHandle = None
-    parentSequence = getRandomSequence(length=random.choice(list(range(1, 2*avgSequenceLength))))[1]
+    parentSequence = _getRandomSequence(random.choice(list(range(1, 2*avgSequenceLength))))
     emptySequenceDirs = set(sequenceDirs)
     i = 0
     while i < sequenceNumber or len(emptySequenceDirs) > 0:
@@ -165,10 +207,11 @@ def getCactusInputs_random(regionNumber=0, tempDir=None,
             if sequenceDir in emptySequenceDirs:
                 emptySequenceDirs.remove(sequenceDir)
             sequenceFile = getTempFile(rootDir=sequenceDir, suffix=suffix)
-            fileHandle = open(sequenceFile, 'w')
+            # one large buffer per file, so each record isn't written a line at a time
+            fileHandle = open(sequenceFile, 'w', buffering=1<<20)
         if random.random() > 0.8: #Get a new root sequence
-            parentSequence = getRandomSequence(length=random.choice(list(range(1, 2*avgSequenceLength))))[1]
-        sequence = mutateSequence(parentSequence, distance=random.random()*0.25)
+            parentSequence = _getRandomSequence(random.choice(list(range(1, 2*avgSequenceLength))))
+        sequence = _mutateSequence(parentSequence, distance=random.random()*0.25)
         name = getRandomAlphaNumericString(15)
         if random.random() > 0.5:
             sequence = reverseComplement(sequence)